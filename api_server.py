@@ -1,16 +1,40 @@
 import os
-import pickle
+
+# Patch blocking I/O before anything else imports socket/ssl
+if os.getenv('USE_GEVENT'):
+    from gevent import monkey
+    monkey.patch_all()
+
+import atexit
+import fcntl
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+import google_auth_httplib2
+import httplib2
+import httpx
 from openai import OpenAI
 import json
+import orjson
+import queue
+import threading
+import hashlib
+import calendar
+import numpy as np
 from datetime import datetime
-from collections import defaultdict
-from flask import Flask, jsonify, request
+from email.utils import parseaddr, parsedate_to_datetime
+from functools import lru_cache
+from contextlib import contextmanager
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 from dotenv import load_dotenv
+from diskcache import Cache
+from pydantic import BaseModel, ConfigDict
+from typing import Literal
 
 # Load environment variables from .env file
 load_dotenv()
@@ -25,12 +49,26 @@ SCOPES = [
 
 # Get configuration from environment variables
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-TOKEN_FILE = os.getenv('GMAIL_TOKEN_FILE', 'token.pkl')
+TOKEN_FILE = os.getenv('GMAIL_TOKEN_FILE', 'token.json')
 PROFILE_FILE = os.getenv('PROFILE_FILE', 'email_profiles.json')
-ANALYSIS_FILE = os.getenv('ANALYSIS_FILE', 'email_analysis.json')
+ANALYSIS_FILE = os.getenv('ANALYSIS_FILE', 'email_analysis.jsonl')
+ANALYSIS_STATS_FILE = os.getenv('ANALYSIS_STATS_FILE', 'email_analysis_stats.json')
+BATCH_JOBS_FILE = os.getenv('BATCH_JOBS_FILE', 'email_batch_jobs.json')
 CREDENTIALS_FILE = os.getenv('GMAIL_CREDENTIALS_FILE', 'credentials.json')
 FLASK_PORT = int(os.getenv('FLASK_PORT', 5000))
 FLASK_DEBUG = os.getenv('FLASK_DEBUG', 'True').lower() == 'true'
+AI_MODEL = os.getenv('AI_MODEL', 'gpt-4o-mini')
+AI_MAX_WORKERS = int(os.getenv('AI_MAX_WORKERS', 10))
+AI_MAX_TOKENS = int(os.getenv('AI_MAX_TOKENS', 256))  # per structured answer
+BATCH_MIN_RESULTS = 5  # requests at or below this size stay synchronous
+BATCH_TERMINAL_STATUSES = ('failed', 'expired', 'cancelled')  # OpenAI batch states that never reach completed
+DOMINANT_SLOT_SHARE = 0.4  # histogram share above which a day/hour slot is trusted without AI
+DOMINANT_SLOT_MIN_SAMPLES = 3
+MAX_SENT_TIMES = 200  # per-sender history kept in a profile
+HTTP_TIMEOUT = int(os.getenv('HTTP_TIMEOUT', 30))  # seconds, Gmail and OpenAI transports
+GMAIL_HTTP_POOL_SIZE = int(os.getenv('GMAIL_HTTP_POOL_SIZE', 16))  # keep-alive Gmail connections per worker
+LLM_CACHE_DIR = os.getenv('LLM_CACHE_DIR', '.llm_cache')
+LLM_CACHE_TTL = int(os.getenv('LLM_CACHE_TTL', 86400))
 
 # Validate OpenAI API key
 if not OPENAI_API_KEY:
@@ -38,11 +76,37 @@ if not OPENAI_API_KEY:
     print("Please add your OpenAI API key to the .env file")
     exit(1)
 
-# Initialize OpenAI client
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Initialize OpenAI client on a pooled keep-alive transport
+client = OpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=httpx.Client(
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        timeout=HTTP_TIMEOUT
+    )
+)
+
+# Shared pool for concurrent OpenAI requests (the client is thread-safe)
+AI_EXECUTOR = ThreadPoolExecutor(max_workers=AI_MAX_WORKERS)
+
+# Naive datetimes are serialized as UTC; numpy values (e.g. histograms) natively
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+class OrjsonProvider(JSONProvider):
+    """Serve Flask JSON through orjson instead of the stdlib encoder."""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=ORJSON_OPTIONS).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 # Initialize Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+def ojson(data, status=200):
+    """Build a JSON response straight from orjson bytes, skipping jsonify."""
+    return app.response_class(orjson.dumps(data, option=ORJSON_OPTIONS), status=status, mimetype='application/json')
 
 # Configure CORS
 cors_origins = os.getenv('CORS_ORIGINS', 'http://localhost:3000,http://localhost:5173').split(',')
@@ -51,47 +115,201 @@ CORS(app, resources={r"/api/*": {"origins": cors_origins}})
 # -----------------------------
 # DATA PERSISTENCE
 # -----------------------------
+# Single worker so background writes land in submission order
+PERSIST_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+atexit.register(PERSIST_EXECUTOR.shutdown, wait=True)
+
+def write_json_file(path, data):
+    """Atomically replace path with data, serialized and written in one call."""
+    payload = orjson.dumps(data, option=ORJSON_OPTIONS | orjson.OPT_INDENT_2)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def write_json_file_in_background(path, data, label):
+    """Queue an atomic write so the request doesn't wait on disk I/O."""
+    def write():
+        try:
+            write_json_file(path, data)
+        except Exception as e:
+            print(f"❌ Error saving {label}: {e}")
+    
+    PERSIST_EXECUTOR.submit(write)
+
 def load_profiles():
     """Load email engagement profiles."""
     if os.path.exists(PROFILE_FILE):
         try:
-            with open(PROFILE_FILE, 'r') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
+            with open(PROFILE_FILE, 'rb') as f:
+                return orjson.loads(f.read())
+        except orjson.JSONDecodeError:
             print(f"⚠️ Warning: {PROFILE_FILE} is corrupted, starting fresh")
             return {}
     return {}
 
 def save_profiles(profiles):
-    """Save email engagement profiles."""
-    try:
-        with open(PROFILE_FILE, 'w') as f:
-            json.dump(profiles, f, indent=2)
-    except Exception as e:
-        print(f"❌ Error saving profiles: {e}")
+    """Save email engagement profiles in the background."""
+    write_json_file_in_background(PROFILE_FILE, profiles, 'profiles')
 
 def load_analysis():
-    """Load email analysis results."""
-    if os.path.exists(ANALYSIS_FILE):
+    """Load email analysis results from the append-only log and stats sidecar."""
+    analysis = {'emails': [], 'stats': {}}
+    
+    if os.path.exists(ANALYSIS_STATS_FILE):
         try:
-            with open(ANALYSIS_FILE, 'r') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            print(f"⚠️ Warning: {ANALYSIS_FILE} is corrupted, starting fresh")
-            return {'emails': [], 'stats': {}}
-    return {'emails': [], 'stats': {}}
+            with open(ANALYSIS_STATS_FILE, 'rb') as f:
+                analysis.update(orjson.loads(f.read()))
+        except orjson.JSONDecodeError:
+            print(f"⚠️ Warning: {ANALYSIS_STATS_FILE} is corrupted, ignoring stats")
+    
+    if os.path.exists(ANALYSIS_FILE):
+        # Later entries for the same message replace earlier ones
+        emails = {}
+        with open(ANALYSIS_FILE, 'rb') as f:
+            for line in f:
+                try:
+                    email = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    print(f"⚠️ Warning: skipping corrupted line in {ANALYSIS_FILE}")
+                    continue
+                emails.pop(email['id'], None)
+                emails[email['id']] = email
+        analysis['emails'] = list(emails.values())
+    
+    return analysis
+
+@lru_cache(maxsize=1)
+def _indexed_analysis(file_version):
+    """Analyzed emails keyed by id; the file version argument invalidates the cache on writes."""
+    return {email['id']: email for email in load_analysis()['emails']}
+
+def get_analyzed_email(email_id):
+    """Look up a single analyzed email without rescanning the log on every call."""
+    if not os.path.exists(ANALYSIS_FILE):
+        return None
+    # Size and inode catch an append or replacement within the mtime's granularity
+    st = os.stat(ANALYSIS_FILE)
+    return _indexed_analysis((st.st_mtime_ns, st.st_size, st.st_ino)).get(email_id)
+
+def append_analysis(analysis):
+    """Append analyzed emails to the log and replace the stats sidecar."""
+    if analysis['emails']:
+        with open(ANALYSIS_FILE, 'ab') as f:
+            f.write(b''.join(orjson.dumps(email, option=ORJSON_OPTIONS) + b'\n' for email in analysis['emails']))
+    write_json_file(ANALYSIS_STATS_FILE, {
+        'stats': analysis['stats'],
+        'timestamp': analysis['timestamp']
+    })
 
 def save_analysis(analysis):
-    """Save email analysis results."""
+    """Save email analysis results in the background."""
+    def write():
+        try:
+            append_analysis(analysis)
+        except Exception as e:
+            print(f"❌ Error saving analysis: {e}")
+    
+    PERSIST_EXECUTOR.submit(write)
+
+def load_batch_jobs():
+    """Load pending OpenAI batch jobs."""
+    if os.path.exists(BATCH_JOBS_FILE):
+        try:
+            with open(BATCH_JOBS_FILE, 'rb') as f:
+                return orjson.loads(f.read())
+        except orjson.JSONDecodeError:
+            print(f"⚠️ Warning: {BATCH_JOBS_FILE} is corrupted, starting fresh")
+            return {}
+    return {}
+
+def save_batch_jobs(jobs):
+    """Save pending OpenAI batch jobs."""
     try:
-        with open(ANALYSIS_FILE, 'w') as f:
-            json.dump(analysis, f, indent=2)
+        write_json_file(BATCH_JOBS_FILE, jobs)
     except Exception as e:
-        print(f"❌ Error saving analysis: {e}")
+        print(f"❌ Error saving batch jobs: {e}")
+
+# Serializes job-store updates across greenlets (the lock) and gunicorn workers (flock)
+BATCH_JOBS_LOCK = threading.Lock()
+
+@contextmanager
+def update_batch_jobs():
+    """Load the batch jobs, let the caller change them, and save them under a lock."""
+    with BATCH_JOBS_LOCK, open(f"{BATCH_JOBS_FILE}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            jobs = load_batch_jobs()
+            yield jobs
+            save_batch_jobs(jobs)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# -----------------------------
+# LLM RESPONSE CACHE
+# -----------------------------
+llm_cache = Cache(LLM_CACHE_DIR)
+
+def llm_cache_key(kind, **inputs):
+    """Build a stable cache key from the inputs that shape an AI prompt."""
+    canonical = json.dumps(inputs, sort_keys=True, separators=(',', ':'))
+    return f"{kind}:{AI_MODEL}:{hashlib.sha256(canonical.encode('utf-8')).hexdigest()}"
+
+# -----------------------------
+# STRUCTURED OUTPUT SCHEMAS
+# -----------------------------
+class OptimalTime(BaseModel):
+    model_config = ConfigDict(extra='forbid')
+    
+    recommended_hour: int
+    recommended_day: str
+    confidence: Literal['high', 'medium', 'low']
+    reasoning: str
+
+class Personalization(BaseModel):
+    model_config = ConfigDict(extra='forbid')
+    
+    tone: str
+    keyTopics: list[str]
+    greeting: str
+    contentHooks: list[str]
+    cta: str
+    notes: str
+
+class EmailAIResult(BaseModel):
+    model_config = ConfigDict(extra='forbid')
+    
+    optimalTime: OptimalTime
+    personalization: Personalization
+
+def json_schema_format(model):
+    """Structured Outputs response_format so the server constrains decoding to the schema."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": model.__name__,
+            "schema": model.model_json_schema(),
+            "strict": True
+        }
+    }
+
+PERSONALIZATION_FORMAT = json_schema_format(Personalization)
+EMAIL_AI_FORMAT = json_schema_format(EmailAIResult)
 
 # -----------------------------
 # AUTHENTICATION
 # -----------------------------
+def load_token():
+    """Load saved Gmail credentials from the JSON token file."""
+    with open(TOKEN_FILE, 'rb') as f:
+        return Credentials.from_authorized_user_info(orjson.loads(f.read()), SCOPES)
+
+def save_token(creds):
+    """Persist Gmail credentials as authorized-user JSON."""
+    write_json_file(TOKEN_FILE, orjson.loads(creds.to_json()))
+
 def setup_credentials_manually():
     """Manual credential setup."""
     print("\n" + "="*70)
@@ -177,36 +395,88 @@ def setup_credentials_manually():
         scopes=SCOPES
     )
     
-    with open(TOKEN_FILE, 'wb') as token:
-        pickle.dump(creds, token)
+    save_token(creds)
     
     print(f"✅ Success! Credentials saved to {TOKEN_FILE}\n")
     
     return creds
 
+# Built service is reused until its credentials stop being valid
+_SERVICE_CACHE = {'creds': None, 'service': None}
+
+# httplib2.Http is not safe for concurrent use: every call, from any greenlet or thread,
+# borrows a connection no one else holds and returns it for the next caller to reuse
+class HttpPool:
+    """Bounded pool of keep-alive httplib2.Http objects, one checked out per request call."""
+    
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+    
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return httplib2.Http(timeout=self.timeout)
+        
+        # Pool exhausted: wait for a connection to come back
+        return self._idle.get()
+    
+    def request(self, *args, **kwargs):
+        http = self._checkout()
+        try:
+            return http.request(*args, **kwargs)
+        except Exception:
+            # Don't hand a half-read socket to the next caller
+            for conn in http.connections.values():
+                conn.close()
+            http.connections.clear()
+            raise
+        finally:
+            self._idle.put(http)
+
+GMAIL_HTTP_POOL = HttpPool(GMAIL_HTTP_POOL_SIZE, HTTP_TIMEOUT)
+
+def build_gmail_service(creds):
+    """Build the Gmail API service from bundled discovery and cache it."""
+    # AuthorizedHttp only adds the auth header; each call borrows its own pooled connection
+    http = google_auth_httplib2.AuthorizedHttp(creds, http=GMAIL_HTTP_POOL)
+    service = build('gmail', 'v1', http=http, cache_discovery=False, static_discovery=True)
+    _SERVICE_CACHE.update(creds=creds, service=service)
+    return service
+
 def get_gmail_service():
     """Authenticate and return Gmail API service."""
+    cached_creds = _SERVICE_CACHE['creds']
+    if cached_creds and cached_creds.valid:
+        return _SERVICE_CACHE['service']
+    
+    _SERVICE_CACHE.update(creds=None, service=None)
     creds = None
     
     if os.path.exists(TOKEN_FILE):
         try:
-            with open(TOKEN_FILE, 'rb') as token:
-                creds = pickle.load(token)
+            creds = load_token()
         except Exception as e:
             print(f"⚠️ Error loading token: {e}")
             creds = None
         
         if creds and creds.valid:
-            service = build('gmail', 'v1', credentials=creds)
-            return service
+            return build_gmail_service(creds)
         
         if creds and creds.expired and creds.refresh_token:
             try:
                 creds.refresh(Request())
-                with open(TOKEN_FILE, 'wb') as token:
-                    pickle.dump(creds, token)
-                service = build('gmail', 'v1', credentials=creds)
-                return service
+                save_token(creds)
+                return build_gmail_service(creds)
             except Exception as e:
                 print(f"⚠️ Token refresh failed: {e}")
                 if os.path.exists(TOKEN_FILE):
@@ -218,18 +488,58 @@ def get_gmail_service():
         if not creds:
             raise Exception("Authentication failed")
     
-    service = build('gmail', 'v1', credentials=creds)
-    return service
+    return build_gmail_service(creds)
+
+# -----------------------------
+# GMAIL FETCHING
+# -----------------------------
+GMAIL_BATCH_SIZE = 100  # Gmail batch endpoint accepts up to 100 calls per request
+METADATA_HEADERS = ['From', 'Subject', 'Date']
+# Partial responses: only the fields the analysis actually reads
+LIST_FIELDS = 'messages/id'
+MESSAGE_FIELDS = 'id,snippet,payload/headers'
+
+def batch_get_messages(service, messages):
+    """Fetch message metadata for a list of message stubs using batched requests."""
+    details = {}
+    
+    def collect(request_id, response, exception):
+        if exception is not None:
+            print(f"⚠️ Error fetching message {request_id}: {exception}")
+            return
+        details[request_id] = response
+    
+    for start in range(0, len(messages), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=collect)
+        for msg in messages[start:start + GMAIL_BATCH_SIZE]:
+            batch.add(
+                service.users().messages().get(
+                    userId='me',
+                    id=msg['id'],
+                    format='metadata',
+                    metadataHeaders=METADATA_HEADERS,
+                    fields=MESSAGE_FIELDS
+                ),
+                request_id=msg['id']
+            )
+        batch.execute()
+    
+    return details
 
 # -----------------------------
 # EMAIL ANALYTICS
 # -----------------------------
+# Date headers repeat across messages and runs; datetimes are immutable so caching is safe.
+# backend/gmail_service.py keeps the same parse_date and size
+DATE_CACHE_SIZE = 4096
+parse_date = lru_cache(maxsize=DATE_CACHE_SIZE)(parsedate_to_datetime)
+
 def analyze_email_patterns(service, max_results=50):
     """Analyze email patterns to build engagement profiles."""
     print(f"📊 Analyzing email patterns from {max_results} recent emails...")
     
     try:
-        results = service.users().messages().list(userId='me', maxResults=max_results).execute()
+        results = service.users().messages().list(userId='me', maxResults=max_results, fields=LIST_FIELDS).execute()
         messages = results.get('messages', [])
     except Exception as e:
         print(f"❌ Error fetching messages: {e}")
@@ -243,9 +553,14 @@ def analyze_email_patterns(service, max_results=50):
         'preferred_time': None
     })
     
+    details = batch_get_messages(service, messages)
+    slots = []  # (sender, weekday, hour) per parsed message
+    
     for msg in messages:
         try:
-            msg_detail = service.users().messages().get(userId='me', id=msg['id'], format='full').execute()
+            msg_detail = details.get(msg['id'])
+            if not msg_detail:
+                continue
             headers = {h['name']: h['value'] for h in msg_detail['payload'].get('headers', [])}
             
             sender = headers.get('From', '')
@@ -253,57 +568,63 @@ def analyze_email_patterns(service, max_results=50):
             date_str = headers.get('Date', '')
             
             # Extract email address
-            if '<' in sender:
-                email = sender.split('<')[1].split('>')[0]
-            else:
-                email = sender.split()[0] if sender else 'unknown'
+            email = parseaddr(sender)[1] or 'unknown'
             
             # Parse date and time
-            from email.utils import parsedate_to_datetime
-            msg_time = parsedate_to_datetime(date_str)
+            msg_time = parse_date(date_str)
             
-            profiles[email]['sent_times'].append({
-                'hour': msg_time.hour,
-                'day': msg_time.strftime('%A'),
-                'timestamp': msg_time.isoformat()
-            })
+            # Messages arrive newest first, so the cap keeps the most recent history
+            if len(profiles[email]['sent_times']) < MAX_SENT_TIMES:
+                profiles[email]['sent_times'].append({
+                    'hour': msg_time.hour,
+                    'day': msg_time.strftime('%A'),
+                    'timestamp': msg_time.isoformat()
+                })
             profiles[email]['topics'].append(subject)
+            slots.append((email, msg_time.weekday(), msg_time.hour))
         except Exception as e:
             print(f"⚠️ Error processing message: {e}")
             continue
     
+    # Per-sender weekday x hour histograms, accumulated in one vectorized pass
+    if slots:
+        index = {email: i for i, email in enumerate(profiles)}
+        senders, days, hours = zip(*slots)
+        histograms = np.zeros((len(index), 7, 24), dtype=np.uint16)
+        np.add.at(histograms, (np.array([index[s] for s in senders]), np.array(days), np.array(hours)), 1)
+        for email, i in index.items():
+            profiles[email]['histogram'] = histograms[i].tolist()
+    
     print(f"✅ Analyzed {len(profiles)} unique senders\n")
     return dict(profiles)
 
 # -----------------------------
 # OPTIMAL SEND TIME PREDICTION
 # -----------------------------
-def predict_optimal_send_time(email_address, profiles):
-    """Use AI to predict optimal send time."""
+def build_send_time_messages(email_address, profiles):
+    """Build the chat messages for a send time prediction, or None without history."""
     profile = profiles.get(email_address, {})
     
     if not profile or not profile.get('sent_times'):
-        return {
-            'recommended_hour': 10,
-            'recommended_day': 'Tuesday',
-            'confidence': 'low',
-            'reasoning': 'No historical data available. Using industry best practices.'
-        }
+        return None
     
     sent_times = profile.get('sent_times', [])
+    # Top counts carry the same signal as the raw lists at a fraction of the tokens
     time_data = {
-        'hours': [t['hour'] for t in sent_times],
-        'days': [t['day'] for t in sent_times],
+        'hours': Counter(t['hour'] for t in sent_times).most_common(5),
+        'days': Counter(t['day'] for t in sent_times).most_common(3),
         'count': len(sent_times)
     }
+    hours_summary = ', '.join(f"{hour}:00 ({count})" for hour, count in time_data['hours'])
+    days_summary = ', '.join(f"{day} ({count})" for day, count in time_data['days'])
     
     prompt = f"""
     Analyze this email engagement data and predict the optimal time to send an email:
     
     Recipient: {email_address}
     Historical data points: {time_data['count']}
-    Hours when emails were received: {time_data['hours']}
-    Days when emails were received: {time_data['days']}
+    Most common hours when emails were received (count): {hours_summary}
+    Most common days when emails were received (count): {days_summary}
     
     Based on this data, provide:
     1. Best hour to send (in 24h format)
@@ -320,32 +641,61 @@ def predict_optimal_send_time(email_address, profiles):
     }}
     """
     
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are an email marketing optimization expert."},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"}
-        )
-        
-        result = json.loads(response.choices[0].message.content)
-        return result
-    except Exception as e:
-        print(f"⚠️ AI prediction failed: {e}")
+    return [
+        {"role": "system", "content": "You are an email marketing optimization expert."},
+        {"role": "user", "content": prompt}
+    ]
+
+def local_send_time(email_address, profiles):
+    """Predict send time without AI when history is missing or clearly dominant."""
+    profile = profiles.get(email_address, {})
+    
+    if not profile or not profile.get('sent_times'):
         return {
             'recommended_hour': 10,
             'recommended_day': 'Tuesday',
             'confidence': 'low',
-            'reasoning': 'Using default timing'
+            'reasoning': 'No historical data available. Using industry best practices.'
         }
+    
+    histogram = np.asarray(profile.get('histogram', []))
+    total = histogram.sum()
+    if histogram.size == 0 or total < DOMINANT_SLOT_MIN_SAMPLES:
+        return None
+    
+    share = histogram.max() / total
+    if share <= DOMINANT_SLOT_SHARE:
+        return None
+    
+    day, hour = (int(i) for i in np.unravel_index(histogram.argmax(), histogram.shape))
+    return {
+        'recommended_hour': hour,
+        'recommended_day': calendar.day_name[day],
+        'confidence': 'high',
+        'reasoning': f"{share:.0%} of emails arrive on {calendar.day_name[day]} around {hour}:00"
+    }
+
+FALLBACK_SEND_TIME = {
+    'recommended_hour': 10,
+    'recommended_day': 'Tuesday',
+    'confidence': 'low',
+    'reasoning': 'Using default timing'
+}
+
+def send_time_cache_inputs(email_address, profiles):
+    """Inputs that determine a send time prediction, for the LLM cache key."""
+    sent_times = profiles[email_address]['sent_times']
+    return {
+        'email': email_address,
+        'hours': sorted(t['hour'] for t in sent_times),
+        'days': sorted(t['day'] for t in sent_times)
+    }
 
 # -----------------------------
 # DYNAMIC CONTENT PERSONALIZATION
 # -----------------------------
-def generate_personalized_content(recipient_email, subject, snippet, profiles):
-    """Generate personalized email content."""
+def build_personalization_messages(recipient_email, subject, snippet, profiles):
+    """Build the chat messages for a personalization strategy."""
     profile = profiles.get(recipient_email, {})
     topics = profile.get('topics', [])
     
@@ -383,37 +733,127 @@ def generate_personalized_content(recipient_email, subject, snippet, profiles):
     }}
     """
     
+    return [
+        {"role": "system", "content": "You are an expert in email personalization and engagement optimization."},
+        {"role": "user", "content": prompt}
+    ]
+
+FALLBACK_PERSONALIZATION = {
+    "tone": "professional",
+    "keyTopics": [],
+    "greeting": "Hello",
+    "contentHooks": [],
+    "cta": "Reply when convenient",
+    "notes": "Standard approach"
+}
+
+def personalization_cache_inputs(recipient_email, subject, snippet, profiles):
+    """Inputs that determine a personalization strategy, for the LLM cache key."""
+    topics = profiles.get(recipient_email, {}).get('topics', [])
+    return {
+        'email': recipient_email,
+        'recent_topics': topics[-5:],
+        'interactions': len(topics),
+        'content': hashlib.sha256(f"{subject}\n{snippet}".encode('utf-8')).hexdigest()
+    }
+
+def generate_personalized_content(recipient_email, subject, snippet, profiles):
+    """Generate personalized email content."""
+    cache_key = llm_cache_key(
+        'personalization',
+        **personalization_cache_inputs(recipient_email, subject, snippet, profiles)
+    )
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
     try:
         response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are an expert in email personalization and engagement optimization."},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"}
+            model=AI_MODEL,
+            messages=build_personalization_messages(recipient_email, subject, snippet, profiles),
+            response_format=PERSONALIZATION_FORMAT,
+            max_tokens=AI_MAX_TOKENS
         )
         
-        return json.loads(response.choices[0].message.content)
+        result = Personalization.model_validate_json(response.choices[0].message.content).model_dump()
+        llm_cache.set(cache_key, result, expire=LLM_CACHE_TTL)
+        return result
     except Exception as e:
         print(f"⚠️ Personalization failed: {e}")
+        return dict(FALLBACK_PERSONALIZATION)
+
+# -----------------------------
+# COMBINED EMAIL ANALYSIS
+# -----------------------------
+def build_email_ai_messages(email, profiles):
+    """Build one set of chat messages covering send time and personalization."""
+    send_time_prompt = build_send_time_messages(email['sender'], profiles)[1]['content']
+    personalization_prompt = build_personalization_messages(
+        email['sender'], email['subject'], email['snippet'], profiles
+    )[1]['content']
+    
+    return [
+        {"role": "system", "content": (
+            "You are an email marketing optimization and personalization expert. "
+            "Return JSON with keys optimalTime and personalization: optimalTime uses the "
+            "send time format and personalization uses the personalization format described below."
+        )},
+        {"role": "user", "content": (
+            f"PART 1 - OPTIMAL SEND TIME (optimalTime):\n{send_time_prompt}\n\n"
+            f"PART 2 - PERSONALIZATION (personalization):\n{personalization_prompt}"
+        )}
+    ]
+
+def analyze_email_ai(email, profiles):
+    """Predict send time and personalization for one email with a single AI call."""
+    local = local_send_time(email['sender'], profiles)
+    if local is not None:
+        # Send time is settled without AI; only personalization needs a call
+        return {
+            'optimalTime': local,
+            'personalization': generate_personalized_content(
+                email['sender'], email['subject'], email['snippet'], profiles
+            )
+        }
+    
+    cache_key = llm_cache_key(
+        'email_ai',
+        send_time=send_time_cache_inputs(email['sender'], profiles),
+        personalization=personalization_cache_inputs(
+            email['sender'], email['subject'], email['snippet'], profiles
+        )
+    )
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    try:
+        response = client.chat.completions.create(
+            model=AI_MODEL,
+            messages=build_email_ai_messages(email, profiles),
+            response_format=EMAIL_AI_FORMAT,
+            max_tokens=2 * AI_MAX_TOKENS
+        )
+        
+        result = EmailAIResult.model_validate_json(response.choices[0].message.content).model_dump()
+        llm_cache.set(cache_key, result, expire=LLM_CACHE_TTL)
+        return result
+    except Exception as e:
+        print(f"⚠️ AI analysis failed: {e}")
         return {
-            "tone": "professional",
-            "keyTopics": [],
-            "greeting": "Hello",
-            "contentHooks": [],
-            "cta": "Reply when convenient",
-            "notes": "Standard approach"
+            'optimalTime': dict(FALLBACK_SEND_TIME),
+            'personalization': dict(FALLBACK_PERSONALIZATION)
         }
 
 # -----------------------------
 # FETCH AND ANALYZE EMAILS
 # -----------------------------
-def fetch_and_analyze_emails(service, profiles, max_results=5):
-    """Fetch and analyze emails."""
+def fetch_recent_emails(service, max_results=5):
+    """Fetch the most recent emails with sender, subject and snippet."""
     print(f"📬 Fetching {max_results} most recent emails...")
     
     try:
-        results = service.users().messages().list(userId='me', maxResults=max_results).execute()
+        results = service.users().messages().list(userId='me', maxResults=max_results, fields=LIST_FIELDS).execute()
         messages = results.get('messages', [])
     except Exception as e:
         print(f"❌ Error fetching messages: {e}")
@@ -423,53 +863,28 @@ def fetch_and_analyze_emails(service, profiles, max_results=5):
         print("📭 No messages found!")
         return []
     
+    details = batch_get_messages(service, messages)
+    
     email_list = []
-    for i, msg in enumerate(messages, 1):
+    for msg in messages:
         try:
-            msg_detail = service.users().messages().get(userId='me', id=msg['id'], format='full').execute()
+            msg_detail = details.get(msg['id'])
+            if not msg_detail:
+                continue
             headers = {h['name']: h['value'] for h in msg_detail['payload'].get('headers', [])}
             
             sender = headers.get('From', 'Unknown')
-            if '<' in sender:
-                email = sender.split('<')[1].split('>')[0]
-                sender_name = sender.split('<')[0].strip().strip('"')
-            else:
-                email = sender.split()[0] if sender else 'unknown'
-                sender_name = sender
-            
-            subject = headers.get('Subject', '(No Subject)')
-            snippet = msg_detail.get('snippet', '')
-            
-            print(f"\n🔍 Analyzing email {i}/{len(messages)}: {subject[:50]}...")
+            sender_name, email = parseaddr(sender)
+            email = email or 'unknown'
+            sender_name = sender_name or sender
             
-            # Predict optimal send time
-            send_time = predict_optimal_send_time(email, profiles)
-            
-            # Generate personalization
-            personalization = generate_personalized_content(email, subject, snippet, profiles)
-            
-            email_data = {
+            email_list.append({
                 "id": msg['id'],
                 "sender": email,
                 "senderName": sender_name,
-                "subject": subject,
-                "snippet": snippet,
-                "optimalTime": {
-                    "day": send_time.get('recommended_day', 'Tuesday'),
-                    "hour": send_time.get('recommended_hour', 10),
-                    "confidence": send_time.get('confidence', 'medium')
-                },
-                "personalization": {
-                    "tone": personalization.get('tone', 'professional'),
-                    "greeting": personalization.get('greeting', 'Hello'),
-                    "keyTopics": personalization.get('keyTopics', []),
-                    "contentHooks": personalization.get('contentHooks', []),
-                    "cta": personalization.get('cta', 'Reply'),
-                    "notes": personalization.get('notes', 'N/A')
-                }
-            }
-            
-            email_list.append(email_data)
+                "subject": headers.get('Subject', '(No Subject)'),
+                "snippet": msg_detail.get('snippet', '')
+            })
             
         except Exception as e:
             print(f"⚠️ Error processing email: {e}")
@@ -477,6 +892,174 @@ def fetch_and_analyze_emails(service, profiles, max_results=5):
     
     return email_list
 
+def build_email_result(email, send_time, personalization):
+    """Combine a fetched email with its AI predictions."""
+    return {
+        **email,
+        "optimalTime": {
+            "day": send_time.get('recommended_day', 'Tuesday'),
+            "hour": send_time.get('recommended_hour', 10),
+            "confidence": send_time.get('confidence', 'medium')
+        },
+        "personalization": {
+            "tone": personalization.get('tone', 'professional'),
+            "greeting": personalization.get('greeting', 'Hello'),
+            "keyTopics": personalization.get('keyTopics', []),
+            "contentHooks": personalization.get('contentHooks', []),
+            "cta": personalization.get('cta', 'Reply'),
+            "notes": personalization.get('notes', 'N/A')
+        }
+    }
+
+def fetch_and_analyze_emails(service, profiles, max_results=5):
+    """Fetch and analyze emails."""
+    emails = fetch_recent_emails(service, max_results=max_results)
+    if not emails:
+        return []
+    
+    print(f"\n🔍 Analyzing {len(emails)} emails concurrently...")
+    
+    # Each email's AI call is independent, so issue them all at once
+    futures = [AI_EXECUTOR.submit(analyze_email_ai, e, profiles) for e in emails]
+    
+    email_list = []
+    for email, future in zip(emails, futures):
+        try:
+            result = future.result()
+            email_list.append(build_email_result(
+                email,
+                result['optimalTime'],
+                result['personalization']
+            ))
+        except Exception as e:
+            print(f"⚠️ Error processing email: {e}")
+            continue
+    
+    return email_list
+
+# -----------------------------
+# OPENAI BATCH JOBS
+# -----------------------------
+def batch_request_line(custom_id, messages, response_format, max_tokens=AI_MAX_TOKENS):
+    """Build one JSONL request line for the OpenAI Batch API."""
+    return json.dumps({
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": AI_MODEL,
+            "messages": messages,
+            "response_format": response_format,
+            "max_tokens": max_tokens
+        }
+    })
+
+def submit_analysis_batch(emails, profiles):
+    """Upload the AI requests for all emails as an OpenAI batch job."""
+    lines = []
+    for email in emails:
+        local = local_send_time(email['sender'], profiles)
+        if local is not None:
+            # Missing or dominant history needs no AI call for the send time
+            email['sendTime'] = local
+            lines.append(batch_request_line(
+                f"{email['id']}:personalization",
+                build_personalization_messages(email['sender'], email['subject'], email['snippet'], profiles),
+                PERSONALIZATION_FORMAT
+            ))
+        else:
+            lines.append(batch_request_line(
+                f"{email['id']}:analysis",
+                build_email_ai_messages(email, profiles),
+                EMAIL_AI_FORMAT,
+                max_tokens=2 * AI_MAX_TOKENS
+            ))
+    
+    batch_file = client.files.create(
+        file=('analysis_batch.jsonl', '\n'.join(lines).encode('utf-8')),
+        purpose='batch'
+    )
+    
+    return client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint='/v1/chat/completions',
+        completion_window='24h'
+    )
+
+def batch_item_error(item):
+    """Describe why a batch output or error-file line failed."""
+    error = item.get('error') or ((item.get('response') or {}).get('body') or {}).get('error') or {}
+    if isinstance(error, dict):
+        return error.get('message') or error.get('code') or f"HTTP {(item.get('response') or {}).get('status_code')}"
+    return str(error)
+
+def collect_batch_results(batch):
+    """Download a completed batch job; returns (results, errors), both keyed by custom_id."""
+    results = {}
+    errors = {}
+    
+    if batch.output_file_id:
+        output = client.files.content(batch.output_file_id).text
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                if item.get('error') or item['response']['status_code'] != 200:
+                    errors[item.get('custom_id')] = batch_item_error(item)
+                    continue
+                body = item['response']['body']
+                results[item['custom_id']] = json.loads(body['choices'][0]['message']['content'])
+            except Exception as e:
+                print(f"⚠️ Error parsing batch result: {e}")
+                continue
+    
+    # Requests that failed outright are only listed in the error file
+    if batch.error_file_id:
+        for line in client.files.content(batch.error_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                errors[item.get('custom_id')] = batch_item_error(item)
+            except Exception as e:
+                print(f"⚠️ Error parsing batch error: {e}")
+    
+    for custom_id, message in errors.items():
+        print(f"⚠️ Batch request {custom_id} failed: {message}")
+    
+    return results, errors
+
+def build_analysis(emails):
+    """Build the analysis payload with summary stats."""
+    if not emails:
+        return {
+            'emails': [],
+            'stats': {
+                'totalEmails': 0,
+                'avgConfidence': 'N/A',
+                'optimizationRate': '0%',
+                'engagementBoost': '0%'
+            },
+            'timestamp': datetime.now().isoformat()
+        }
+    
+    # Calculate stats
+    total_confidence = sum(1 for e in emails if e['optimalTime']['confidence'] == 'high')
+    
+    stats = {
+        'totalEmails': len(emails),
+        'avgConfidence': 'High' if total_confidence / len(emails) > 0.6 else 'Medium' if total_confidence / len(emails) > 0.3 else 'Low',
+        'optimizationRate': f"{int((total_confidence / len(emails)) * 100)}%",
+        'engagementBoost': '+34%'
+    }
+    
+    return {
+        'emails': emails,
+        'stats': stats,
+        'timestamp': datetime.now().isoformat()
+    }
+
 # -----------------------------
 # API ENDPOINTS
 # -----------------------------
@@ -497,124 +1080,222 @@ def analyze():
         print("🤖 Analyzing emails with AI...")
         emails = fetch_and_analyze_emails(service, profiles, max_results=max_results)
         
+        analysis = build_analysis(emails)
         if not emails:
-            return jsonify({
-                'emails': [],
-                'stats': {
-                    'totalEmails': 0,
-                    'avgConfidence': 'N/A',
-                    'optimizationRate': '0%',
-                    'engagementBoost': '0%'
-                },
-                'timestamp': datetime.now().isoformat()
-            })
+            return ojson(analysis)
+        
+        save_analysis(analysis)
         
-        # Calculate stats
-        total_confidence = sum(1 for e in emails if e['optimalTime']['confidence'] == 'high')
+        print(f"✅ Analysis complete! Processed {len(emails)} emails\n")
         
-        stats = {
-            'totalEmails': len(emails),
-            'avgConfidence': 'High' if total_confidence / len(emails) > 0.6 else 'Medium' if total_confidence / len(emails) > 0.3 else 'Low',
-            'optimizationRate': f"{int((total_confidence / len(emails)) * 100)}%",
-            'engagementBoost': '+34%'
-        }
+        return ojson(analysis)
+    
+    except Exception as e:
+        print(f"❌ Error in analyze endpoint: {e}")
+        return ojson({'error': str(e)}, 500)
+
+@app.route('/api/analyze/batch', methods=['POST'])
+def analyze_batch():
+    """Submit a large analysis as an OpenAI batch job."""
+    try:
+        data = request.json
+        max_results = data.get('maxResults', 5)
         
-        analysis = {
-            'emails': emails,
-            'stats': stats,
-            'timestamp': datetime.now().isoformat()
-        }
+        # Small requests are cheap enough to answer synchronously
+        if max_results <= BATCH_MIN_RESULTS:
+            return analyze()
+        
+        print("🔐 Authenticating with Gmail...")
+        service = get_gmail_service()
+        
+        print("📊 Building engagement profiles...")
+        profiles = analyze_email_patterns(service, max_results=50)
+        save_profiles(profiles)
+        
+        emails = fetch_recent_emails(service, max_results=max_results)
+        if not emails:
+            return ojson(build_analysis([]))
+        
+        print(f"📦 Submitting OpenAI batch job for {len(emails)} emails...")
+        batch = submit_analysis_batch(emails, profiles)
+        
+        with update_batch_jobs() as jobs:
+            jobs[batch.id] = {
+                'emails': emails,
+                'submitted': datetime.now().isoformat()
+            }
+        
+        return ojson({'batchId': batch.id, 'status': batch.status}, 202)
+    
+    except Exception as e:
+        print(f"❌ Error in batch analyze endpoint: {e}")
+        return ojson({'error': str(e)}, 500)
+
+@app.route('/api/analyze/batch/<batch_id>', methods=['GET'])
+def analyze_batch_status(batch_id):
+    """Poll an OpenAI batch job and store its results once complete."""
+    job = load_batch_jobs().get(batch_id)
+    
+    if not job:
+        return ojson({'error': 'Batch job not found'}, 404)
+    
+    try:
+        batch = client.batches.retrieve(batch_id)
+        
+        # These never complete, so stop the client polling and drop the job
+        if batch.status in BATCH_TERMINAL_STATUSES:
+            with update_batch_jobs() as jobs:
+                jobs.pop(batch_id, None)
+            print(f"❌ Batch job {batch_id} ended with status {batch.status}")
+            return ojson({'batchId': batch_id, 'status': batch.status, 'error': f"Batch job {batch.status}"}, 410)
+        
+        if batch.status != 'completed':
+            return ojson({'batchId': batch_id, 'status': batch.status}, 202)
         
+        results, errors = collect_batch_results(batch)
+        emails = []
+        failed = []
+        for email in job['emails']:
+            # Each email had exactly one request; without its result there is nothing real to store
+            custom_id = f"{email['id']}:personalization" if email.get('sendTime') else f"{email['id']}:analysis"
+            result = results.get(custom_id)
+            if result is None:
+                failed.append({'id': email['id'], 'error': errors.get(custom_id, 'No result returned')})
+                continue
+            
+            if email.get('sendTime'):
+                send_time, personalization = email['sendTime'], result
+            else:
+                send_time, personalization = result.get('optimalTime') or {}, result.get('personalization') or {}
+            emails.append(build_email_result(
+                {k: v for k, v in email.items() if k != 'sendTime'},
+                send_time,
+                personalization
+            ))
+        
+        with update_batch_jobs() as jobs:
+            jobs.pop(batch_id, None)
+        
+        if not emails:
+            print(f"❌ Batch job {batch_id} returned no usable results")
+            return ojson({'batchId': batch_id, 'status': batch.status, 'error': 'All batch requests failed', 'failed': failed}, 502)
+        
+        analysis = build_analysis(emails)
         save_analysis(analysis)
         
-        print(f"✅ Analysis complete! Processed {len(emails)} emails\n")
+        print(f"✅ Batch analysis complete! Processed {len(emails)} emails, {len(failed)} failed\n")
         
-        return jsonify(analysis)
+        return ojson({**analysis, 'failed': failed})
     
     except Exception as e:
-        print(f"❌ Error in analyze endpoint: {e}")
-        return jsonify({'error': str(e)}), 500
+        print(f"❌ Error in batch status endpoint: {e}")
+        return ojson({'error': str(e)}, 500)
 
 @app.route('/api/data', methods=['GET'])
 def get_data():
     """Get stored analysis data."""
     analysis = load_analysis()
-    return jsonify(analysis)
+    return ojson(analysis)
 
-@app.route('/api/export/<email_id>', methods=['GET'])
-def export_email(email_id):
-    """Export a single email's analysis."""
-    analysis = load_analysis()
-    email = next((e for e in analysis.get('emails', []) if e['id'] == email_id), None)
-    
-    if not email:
-        return jsonify({'error': 'Email not found'}), 404
-    
-    format_type = request.args.get('format', 'markdown')
-    separator = '=' * 50
-    
-    if format_type == 'markdown':
-        content = f"""# Email Personalization Strategy
+# -----------------------------
+# EXPORT TEMPLATES
+# -----------------------------
+EXPORT_SEPARATOR = '=' * 50
+
+MD_TEMPLATE = """# Email Personalization Strategy
 
 ## Recipient Information
-- **Email:** {email['sender']}
-- **Name:** {email['senderName']}
-- **Subject:** {email['subject']}
+- **Email:** {sender}
+- **Name:** {senderName}
+- **Subject:** {subject}
 
 ## Optimal Send Time
-- **Best Day:** {email['optimalTime']['day']}
-- **Best Time:** {email['optimalTime']['hour']}:00
-- **Confidence:** {email['optimalTime']['confidence'].upper()}
+- **Best Day:** {day}
+- **Best Time:** {hour}:00
+- **Confidence:** {confidence}
 
 ## Personalization Strategy
-- **Recommended Tone:** {email['personalization']['tone']}
-- **Suggested Greeting:** {email['personalization']['greeting']}
-- **Key Topics:** {', '.join(email['personalization']['keyTopics'])}
-- **Content Hooks:** {', '.join(email['personalization']['contentHooks'])}
-- **Call-to-Action:** {email['personalization']['cta']}
+- **Recommended Tone:** {tone}
+- **Suggested Greeting:** {greeting}
+- **Key Topics:** {keyTopics}
+- **Content Hooks:** {contentHooks}
+- **Call-to-Action:** {cta}
 
 ## Notes
-{email['personalization']['notes']}
+{notes}
 
 ---
 Generated by BOB 2 Email AI Assistant
-Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+Date: {date}
 """
-    else:
-        content = f"""EMAIL PERSONALIZATION STRATEGY
+
+TXT_TEMPLATE = """EMAIL PERSONALIZATION STRATEGY
 {separator}
 
 RECIPIENT INFORMATION
-Email: {email['sender']}
-Name: {email['senderName']}
-Subject: {email['subject']}
+Email: {sender}
+Name: {senderName}
+Subject: {subject}
 
 OPTIMAL SEND TIME
-Best Day: {email['optimalTime']['day']}
-Best Time: {email['optimalTime']['hour']}:00
-Confidence: {email['optimalTime']['confidence'].upper()}
+Best Day: {day}
+Best Time: {hour}:00
+Confidence: {confidence}
 
 PERSONALIZATION STRATEGY
-Recommended Tone: {email['personalization']['tone']}
-Suggested Greeting: {email['personalization']['greeting']}
-Key Topics: {', '.join(email['personalization']['keyTopics'])}
-Content Hooks: {', '.join(email['personalization']['contentHooks'])}
-Call-to-Action: {email['personalization']['cta']}
+Recommended Tone: {tone}
+Suggested Greeting: {greeting}
+Key Topics: {keyTopics}
+Content Hooks: {contentHooks}
+Call-to-Action: {cta}
 
 NOTES
-{email['personalization']['notes']}
+{notes}
 
 {separator}
 Generated by BOB 2 Email AI Assistant
-Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+Date: {date}
 """
+
+def export_context(email):
+    """Flatten an analyzed email into the fields used by the export templates."""
+    optimal_time = email['optimalTime']
+    personalization = email['personalization']
+    return {
+        'sender': email['sender'],
+        'senderName': email['senderName'],
+        'subject': email['subject'],
+        'day': optimal_time['day'],
+        'hour': optimal_time['hour'],
+        'confidence': optimal_time['confidence'].upper(),
+        'tone': personalization['tone'],
+        'greeting': personalization['greeting'],
+        'keyTopics': ', '.join(personalization['keyTopics']),
+        'contentHooks': ', '.join(personalization['contentHooks']),
+        'cta': personalization['cta'],
+        'notes': personalization['notes'],
+        'separator': EXPORT_SEPARATOR,
+        'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+
+@app.route('/api/export/<email_id>', methods=['GET'])
+def export_email(email_id):
+    """Export a single email's analysis."""
+    email = get_analyzed_email(email_id)
+    
+    if not email:
+        return ojson({'error': 'Email not found'}, 404)
+    
+    format_type = request.args.get('format', 'markdown')
+    template = MD_TEMPLATE if format_type == 'markdown' else TXT_TEMPLATE
+    content = template.format_map(export_context(email))
     
     return content, 200, {'Content-Type': 'text/plain'}
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint."""
-    return jsonify({
+    return ojson({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
         'authenticated': os.path.exists(TOKEN_FILE)
@@ -623,12 +1304,14 @@ def health_check():
 @app.route('/')
 def index():
     """Serve basic info page."""
-    return jsonify({
+    return ojson({
         'name': 'BOB 2 Email AI Assistant API',
         'version': '1.0.0',
         'status': 'running',
         'endpoints': {
             'POST /api/analyze': 'Analyze emails',
+            'POST /api/analyze/batch': 'Analyze emails via OpenAI batch job',
+            'GET /api/analyze/batch/<batch_id>': 'Get batch job results',
             'GET /api/data': 'Get stored analysis',
             'GET /api/export/<email_id>': 'Export email analysis',
             'GET /api/health': 'Health check'
@@ -667,4 +1350,10 @@ if __name__ == '__main__':
     print("📱 Open the React dashboard to use the UI\n")
     print("💡 Press Ctrl+C to stop the server\n")
     
-    app.run(debug=FLASK_DEBUG, port=FLASK_PORT, host='0.0.0.0')
\ No newline at end of file
+    if FLASK_DEBUG:
+        # Werkzeug's dev server handles one request at a time; debug use only
+        app.run(debug=FLASK_DEBUG, port=FLASK_PORT, host='0.0.0.0')
+    else:
+        # Production: hand off to gunicorn with gevent workers
+        config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py')
+        os.execvp('gunicorn', ['gunicorn', '-c', config_path, 'api_server:app'])
\ No newline at end of file
@@ -4,22 +4,35 @@ from flask_jwt_extended import JWTManager, jwt_required, get_jwt_identity
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from config import Config
-from models import db, bcrypt, User, EmailAnalysis, UsageLog
+from models import db, bcrypt, User, EmailAnalysis
 from auth import auth_bp
 from payment import payment_bp
+from tasks import celery_init_app
 from gmail_service import get_gmail_service, initiate_gmail_oauth, complete_gmail_oauth, fetch_emails, analyze_email_patterns
-from ai_service import analyze_email_batch
-from datetime import datetime
+from ai_service import analyze_email_batch, ai_call_count
+from cache import cached_user, invalidate_user
+from openai_bucket import openai_bucket
+from responses import ojsonify, OrjsonProvider
+import usage_logger
+from log_queue import init_logging
+from datetime import datetime, timezone
+from sqlalchemy import insert, update, select, func, or_, and_
+import asyncio
 import os
 
+init_logging()
+
 # Initialize Flask app
 app = Flask(__name__)
 app.config.from_object(Config)
+app.json = OrjsonProvider(app)
 
 # Initialize extensions
 db.init_app(app)
 bcrypt.init_app(app)
+usage_logger.init_app(app)
 jwt = JWTManager(app)
+celery_app = celery_init_app(app)
 
 # CORS configuration
 CORS(app, resources={
@@ -31,19 +44,27 @@ CORS(app, resources={
     }
 })
 
-# Rate limiting
+# Rate limiting (moving window runs as an atomic sorted-set script in Redis)
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
     default_limits=["200 per day", "50 per hour"],
-    storage_uri=Config.REDIS_URL
+    storage_uri=Config.REDIS_URL,
+    strategy='moving-window',
+    headers_enabled=True
 )
 
+
+def user_rate_limit_key():
+    """Rate-limit authenticated routes per user instead of per IP"""
+    user_id = get_jwt_identity()
+    return f"user:{user_id}" if user_id else get_remote_address()
+
 # Register blueprints
 app.register_blueprint(auth_bp, url_prefix='/api/auth')
 app.register_blueprint(payment_bp, url_prefix='/api/payment')
 
-# Create tables
+# Create tables (existing databases are upgraded once at deploy by migrate.py)
 with app.app_context():
     db.create_all()
 
@@ -84,12 +105,12 @@ def health():
 
 @app.route('/api/gmail/connect', methods=['POST'])
 @jwt_required()
-@limiter.limit("5 per hour")
+@limiter.limit("5 per hour", key_func=user_rate_limit_key)
 def gmail_connect():
     """Initiate Gmail OAuth connection"""
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        user = cached_user(user_id)
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
@@ -114,7 +135,8 @@ def gmail_callback():
     """Complete Gmail OAuth with authorization code"""
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        # Reads Gmail credential columns, which the user cache leaves out
+        user = db.session.get(User, user_id)
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
@@ -143,12 +165,13 @@ def gmail_status():
     """Check Gmail connection status"""
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        # Reads Gmail credential columns, which the user cache leaves out
+        user = db.session.get(User, user_id)
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
-        connected = bool(user.gmail_credentials)
+        connected = user.has_gmail_credentials()
         
         return jsonify({
             'connected': connected,
@@ -165,21 +188,23 @@ def gmail_status():
 
 @app.route('/api/analyze', methods=['POST'])
 @jwt_required()
-@limiter.limit("10 per hour")
-def analyze_emails():
+@limiter.limit("10 per hour", key_func=user_rate_limit_key)
+async def analyze_emails():
     """Analyze emails with AI"""
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        # The Gmail service needs the credential columns, which the user cache leaves out
+        user = db.session.get(User, user_id)
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
         # Check usage limit
-        if not user.can_analyze_email():
+        usage_limit = user.get_usage_limit()
+        if user.emails_analyzed_this_month >= usage_limit:
             return jsonify({
                 'error': 'Usage limit reached',
-                'limit': user.get_usage_limit(),
+                'limit': usage_limit,
                 'used': user.emails_analyzed_this_month,
                 'upgrade_required': True
             }), 429
@@ -197,8 +222,8 @@ def analyze_emails():
         
         print(f"Fetching {max_results} emails for user {user.id}...")
         
-        # Fetch emails
-        emails = fetch_emails(service, max_results=50)
+        # Fetch emails off the event loop
+        emails = await asyncio.to_thread(fetch_emails, service, max_results=50)
         
         # Analyze patterns
         profiles = analyze_email_patterns(emails)
@@ -206,59 +231,83 @@ def analyze_emails():
         # Get emails to analyze
         emails_to_analyze = emails[:max_results]
         
+        # Reserve OpenAI capacity before fanning out
+        allowed, retry_after = openai_bucket.take(cost=ai_call_count(len(emails_to_analyze)))
+        if not allowed:
+            return jsonify({
+                'error': 'AI capacity temporarily exhausted',
+                'retry_after': retry_after
+            }), 429, {'Retry-After': str(retry_after)}
+        
         # Analyze with AI
-        analyzed_emails = analyze_email_batch(emails_to_analyze, profiles)
-        
-        # Save to database
-        for email_data in analyzed_emails:
-            analysis = EmailAnalysis(
-                user_id=user.id,
-                email_id=email_data['id'],
-                sender=email_data['sender'],
-                sender_name=email_data['senderName'],
-                subject=email_data['subject'],
-                snippet=email_data['snippet'],
-                optimal_day=email_data['optimalTime']['day'],
-                optimal_hour=email_data['optimalTime']['hour'],
-                confidence=email_data['optimalTime']['confidence'],
-                tone=email_data['personalization']['tone'],
-                greeting=email_data['personalization']['greeting'],
-                key_topics=email_data['personalization']['keyTopics'],
-                content_hooks=email_data['personalization']['contentHooks'],
-                cta=email_data['personalization']['cta'],
-                notes=email_data['personalization']['notes']
+        analyzed_emails = await analyze_email_batch(emails_to_analyze, profiles)
+        
+        # Save to database in one bulk INSERT
+        rows = [{
+            'user_id': user.id,
+            'email_id': email_data['id'],
+            'sender': email_data['sender'],
+            'sender_name': email_data['senderName'],
+            'subject': email_data['subject'],
+            'snippet': email_data['snippet'],
+            'optimal_day': email_data['optimalTime']['day'],
+            'optimal_hour': email_data['optimalTime']['hour'],
+            'confidence': email_data['optimalTime']['confidence'],
+            'tone': email_data['personalization']['tone'],
+            'greeting': email_data['personalization']['greeting'],
+            'key_topics': email_data['personalization']['keyTopics'],
+            'content_hooks': email_data['personalization']['contentHooks'],
+            'cta': email_data['personalization']['cta'],
+            'notes': email_data['personalization']['notes']
+        } for email_data in analyzed_emails]
+        
+        with db.session.no_autoflush:
+            if rows and db.engine.dialect.insert_executemany_returning_sort_by_parameter_order:
+                # RETURNING hands back the new ids in row order within the same round trip
+                result = db.session.execute(
+                    insert(EmailAnalysis).returning(EmailAnalysis.id, sort_by_parameter_order=True),
+                    rows
+                )
+                for email_data, analysis_id in zip(analyzed_emails, result.scalars()):
+                    email_data['analysisId'] = analysis_id
+            elif rows:
+                db.session.execute(insert(EmailAnalysis), rows)
+            
+            # Update usage atomically in SQL so concurrent analyses can't lose increments
+            analyzed_count = len(analyzed_emails)
+            db.session.execute(
+                update(User)
+                .where(User.id == user.id)
+                .values(
+                    emails_analyzed_this_month=User.emails_analyzed_this_month + analyzed_count,
+                    total_emails_analyzed=User.total_emails_analyzed + analyzed_count
+                )
             )
-            db.session.add(analysis)
-        
-        # Update usage
-        user.emails_analyzed_this_month += len(analyzed_emails)
-        user.total_emails_analyzed += len(analyzed_emails)
-        
-        # Log usage
-        usage_log = UsageLog(
-            user_id=user.id,
-            action='email_analyzed',
-            details={'count': len(analyzed_emails)}
-        )
-        db.session.add(usage_log)
         
         db.session.commit()
+        invalidate_user(user.id)
+        
+        # Log usage (written in the background)
+        usage_logger.emit(user.id, 'email_analyzed', {'count': len(analyzed_emails)})
         
         # Calculate stats
         high_confidence = sum(1 for e in analyzed_emails 
                             if e['optimalTime']['confidence'] == 'high')
         
+        high_ratio = high_confidence / len(analyzed_emails) if analyzed_emails else 0
+        used = user.emails_analyzed_this_month
+        
         stats = {
             'totalEmails': len(analyzed_emails),
-            'avgConfidence': 'High' if high_confidence / len(analyzed_emails) > 0.6 
-                           else 'Medium' if high_confidence / len(analyzed_emails) > 0.3 
+            'avgConfidence': 'High' if high_ratio > 0.6 
+                           else 'Medium' if high_ratio > 0.3 
                            else 'Low',
-            'optimizationRate': f"{int((high_confidence / len(analyzed_emails)) * 100)}%",
+            'optimizationRate': f"{int(high_ratio * 100)}%",
             'engagementBoost': '+34%',
             'usage': {
-                'used': user.emails_analyzed_this_month,
-                'limit': user.get_usage_limit(),
-                'remaining': user.get_usage_limit() - user.emails_analyzed_this_month
+                'used': used,
+                'limit': usage_limit,
+                'remaining': usage_limit - used
             }
         }
         
@@ -280,14 +329,50 @@ def get_analyses():
     """Get user's previous analyses"""
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        user = cached_user(user_id)
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
         # Get pagination parameters
         page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
+        per_page = max(1, min(request.args.get('per_page', 20, type=int), 100))
+        before = request.args.get('before')
+        
+        # Keyset pagination (?before=<created_at>&before_id=<id>) avoids OFFSET on deep pages
+        if before:
+            try:
+                before_at = datetime.fromisoformat(before)
+            except ValueError:
+                return jsonify({'error': 'Invalid before cursor'}), 400
+            if before_at.tzinfo:
+                # created_at values are serialized as UTC offsets but stored naive
+                before_at = before_at.astimezone(timezone.utc).replace(tzinfo=None)
+            
+            before_id = request.args.get('before_id', type=int)
+            if before_id is None:
+                cursor = EmailAnalysis.created_at < before_at
+            else:
+                cursor = or_(
+                    EmailAnalysis.created_at < before_at,
+                    and_(EmailAnalysis.created_at == before_at, EmailAnalysis.id < before_id)
+                )
+            
+            items = EmailAnalysis.query.filter_by(user_id=user.id)\
+                .filter(cursor)\
+                .order_by(EmailAnalysis.created_at.desc(), EmailAnalysis.id.desc())\
+                .limit(per_page).all()
+            
+            last = items[-1] if len(items) == per_page else None
+            
+            return ojsonify({
+                'analyses': [analysis.to_dict() for analysis in items],
+                'pagination': {
+                    'per_page': per_page,
+                    'next_before': last.created_at.isoformat() if last else None,
+                    'next_before_id': last.id if last else None
+                }
+            })
         
         # Query analyses
         analyses_query = EmailAnalysis.query.filter_by(user_id=user.id)\
@@ -301,7 +386,7 @@ def get_analyses():
         
         analyses = [analysis.to_dict() for analysis in paginated.items]
         
-        return jsonify({
+        return ojsonify({
             'analyses': analyses,
             'pagination': {
                 'page': page,
@@ -309,92 +394,107 @@ def get_analyses():
                 'total': paginated.total,
                 'pages': paginated.pages
             }
-        }), 200
+        })
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/export/<int:analysis_id>', methods=['GET'])
-@jwt_required()
-def export_analysis(analysis_id):
-    """Export a single analysis"""
-    try:
-        user_id = get_jwt_identity()
-        analysis = EmailAnalysis.query.filter_by(
-            id=analysis_id,
-            user_id=user_id
-        ).first()
-        
-        if not analysis:
-            return jsonify({'error': 'Analysis not found'}), 404
-        
-        format_type = request.args.get('format', 'markdown')
-        separator = '=' * 50
-        
-        if format_type == 'markdown':
-            content = f"""# Email Personalization Strategy
+_SEP = '=' * 50
+_APP_NAME = Config.APP_NAME
+
+_MD_TEMPLATE = """# Email Personalization Strategy
 
 ## Recipient Information
-- **Email:** {analysis.sender}
-- **Name:** {analysis.sender_name}
-- **Subject:** {analysis.subject}
+- **Email:** {sender}
+- **Name:** {sender_name}
+- **Subject:** {subject}
 
 ## Optimal Send Time
-- **Best Day:** {analysis.optimal_day}
-- **Best Time:** {analysis.optimal_hour}:00
-- **Confidence:** {analysis.confidence.upper()}
+- **Best Day:** {optimal_day}
+- **Best Time:** {optimal_hour}:00
+- **Confidence:** {confidence}
 
 ## Personalization Strategy
-- **Recommended Tone:** {analysis.tone}
-- **Suggested Greeting:** {analysis.greeting}
-- **Key Topics:** {', '.join(analysis.key_topics or [])}
-- **Content Hooks:** {', '.join(analysis.content_hooks or [])}
-- **Call-to-Action:** {analysis.cta}
+- **Recommended Tone:** {tone}
+- **Suggested Greeting:** {greeting}
+- **Key Topics:** {key_topics}
+- **Content Hooks:** {content_hooks}
+- **Call-to-Action:** {cta}
 
 ## Notes
-{analysis.notes}
+{notes}
 
 ---
-Generated by {Config.APP_NAME}
-Date: {datetime.utcnow().strftime('%Y-%m-%d %H:%M')}
-Analysis ID: {analysis.id}
+Generated by {app}
+Date: {now}
+Analysis ID: {id}
 """
-        else:
-            content = f"""EMAIL PERSONALIZATION STRATEGY
-{separator}
 
-RECIPIENT: {analysis.sender}
-NAME: {analysis.sender_name}
-SUBJECT: {analysis.subject}
+_TXT_TEMPLATE = """EMAIL PERSONALIZATION STRATEGY
+{sep}
+
+RECIPIENT: {sender}
+NAME: {sender_name}
+SUBJECT: {subject}
 
 OPTIMAL SEND TIME
-Day: {analysis.optimal_day}
-Time: {analysis.optimal_hour}:00
-Confidence: {analysis.confidence.upper()}
+Day: {optimal_day}
+Time: {optimal_hour}:00
+Confidence: {confidence}
 
 PERSONALIZATION
-Tone: {analysis.tone}
-Greeting: {analysis.greeting}
-Topics: {', '.join(analysis.key_topics or [])}
-Hooks: {', '.join(analysis.content_hooks or [])}
-CTA: {analysis.cta}
+Tone: {tone}
+Greeting: {greeting}
+Topics: {key_topics}
+Hooks: {content_hooks}
+CTA: {cta}
 
-NOTES: {analysis.notes}
+NOTES: {notes}
 
-{separator}
-Generated: {datetime.utcnow().strftime('%Y-%m-%d %H:%M')}
-Analysis ID: {analysis.id}
+{sep}
+Generated: {now}
+Analysis ID: {id}
 """
+
+
+@app.route('/api/export/<int:analysis_id>', methods=['GET'])
+@jwt_required()
+def export_analysis(analysis_id):
+    """Export a single analysis"""
+    try:
+        user_id = get_jwt_identity()
+        analysis = EmailAnalysis.query.filter_by(
+            id=analysis_id,
+            user_id=user_id
+        ).first()
+        
+        if not analysis:
+            return jsonify({'error': 'Analysis not found'}), 404
         
-        # Log export
-        usage_log = UsageLog(
-            user_id=user_id,
-            action='export',
-            details={'analysis_id': analysis_id, 'format': format_type}
+        format_type = request.args.get('format', 'markdown')
+        tpl = _MD_TEMPLATE if format_type == 'markdown' else _TXT_TEMPLATE
+        content = tpl.format(
+            id=analysis.id,
+            sender=analysis.sender,
+            sender_name=analysis.sender_name,
+            subject=analysis.subject,
+            optimal_day=analysis.optimal_day,
+            optimal_hour=analysis.optimal_hour,
+            confidence=analysis.confidence.upper(),
+            tone=analysis.tone,
+            greeting=analysis.greeting,
+            key_topics=', '.join(analysis.key_topics or []),
+            content_hooks=', '.join(analysis.content_hooks or []),
+            cta=analysis.cta,
+            notes=analysis.notes,
+            sep=_SEP,
+            app=_APP_NAME,
+            now=datetime.utcnow().strftime('%Y-%m-%d %H:%M')
         )
-        db.session.add(usage_log)
-        db.session.commit()
+        
+        # Log export (written in the background)
+        usage_logger.emit(user_id, 'export', {'analysis_id': analysis_id, 'format': format_type})
         
         return content, 200, {'Content-Type': 'text/plain'}
         
@@ -408,28 +508,35 @@ def get_user_stats():
     """Get user statistics"""
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        # to_dict needs api_key, which is never cached, so this reads the row directly
+        user = db.session.get(User, user_id)
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
-        # Get analyses count
-        total_analyses = EmailAnalysis.query.filter_by(user_id=user.id).count()
+        # Recent analyses and the total count in one round trip
+        rows = db.session.execute(
+            select(EmailAnalysis, func.count().over().label('total'))
+            .where(EmailAnalysis.user_id == user.id)
+            .order_by(EmailAnalysis.created_at.desc())
+            .limit(5)
+        ).all()
+        
+        recent = [row.EmailAnalysis for row in rows]
+        total_analyses = rows[0].total if rows else 0
         
-        # Get recent analyses
-        recent = EmailAnalysis.query.filter_by(user_id=user.id)\
-            .order_by(EmailAnalysis.created_at.desc())\
-            .limit(5).all()
+        usage_limit = user.get_usage_limit()
+        used = user.emails_analyzed_this_month
         
         stats = {
             'user': user.to_dict(),
             'total_analyses': total_analyses,
             'recent_analyses': [a.to_dict() for a in recent],
             'usage': {
-                'current_month': user.emails_analyzed_this_month,
-                'limit': user.get_usage_limit(),
-                'remaining': user.get_usage_limit() - user.emails_analyzed_this_month,
-                'percentage': (user.emails_analyzed_this_month / user.get_usage_limit()) * 100
+                'current_month': used,
+                'limit': usage_limit,
+                'remaining': usage_limit - used,
+                'percentage': 100.0 * used / usage_limit if usage_limit > 0 else 0.0
             }
         }
         
@@ -1,6 +1,7 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import create_access_token, create_refresh_token, jwt_required, get_jwt_identity
 from models import db, User, UsageLog
+from cache import invalidate_user
 from datetime import datetime
 import secrets
 
@@ -72,6 +73,7 @@ def login():
         # Update last login
         user.last_login = datetime.utcnow()
         db.session.commit()
+        invalidate_user(user.id)
         
         # Create tokens
         access_token = create_access_token(identity=user.id)
@@ -102,7 +104,8 @@ def refresh():
 def get_current_user():
     """Get current user info"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    # to_dict needs api_key, which is never cached, so a cache hit would still hit the database
+    user = db.session.get(User, user_id)
     
     if not user:
         return jsonify({'error': 'User not found'}), 404
@@ -116,7 +119,8 @@ def update_profile():
     """Update user profile"""
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        # Returns to_dict(), whose api_key the user cache leaves out
+        user = db.session.get(User, user_id)
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
@@ -134,6 +138,7 @@ def update_profile():
             user.email_verified = False
         
         db.session.commit()
+        invalidate_user(user.id)
         
         return jsonify({
             'message': 'Profile updated successfully',
@@ -151,7 +156,8 @@ def change_password():
     """Change user password"""
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        # Needs password_hash, which the user cache leaves out
+        user = db.session.get(User, user_id)
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
@@ -168,6 +174,7 @@ def change_password():
         
         user.set_password(new_password)
         db.session.commit()
+        invalidate_user(user.id)
         
         return jsonify({'message': 'Password changed successfully'}), 200
         
@@ -182,13 +189,15 @@ def regenerate_api_key():
     """Regenerate API key"""
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        # Returns to_dict(), whose api_key the user cache leaves out
+        user = db.session.get(User, user_id)
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
         user.generate_api_key()
         db.session.commit()
+        invalidate_user(user.id)
         
         return jsonify({
             'message': 'API key regenerated',
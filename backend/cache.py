@@ -0,0 +1,184 @@
+import redis
+import msgpack
+import logging
+import time
+from datetime import datetime
+from sqlalchemy.orm import make_transient_to_detached
+from config import Config
+from models import db, User
+
+logger = logging.getLogger(__name__)
+
+redis_client = redis.Redis.from_url(
+    Config.REDIS_URL,
+    socket_connect_timeout=0.25,
+    socket_timeout=0.25
+)
+
+# Only non-sensitive columns are cached; secrets stay in the database and lazy-load on access
+USER_CACHE_COLUMNS = (
+    'id', 'email', 'full_name',
+    'subscription_tier', 'subscription_status',
+    'stripe_customer_id', 'stripe_subscription_id',
+    'emails_analyzed_this_month', 'total_emails_analyzed',
+    'email_verified', 'created_at', 'updated_at', 'last_login'
+)
+USER_DATETIME_COLUMNS = ('created_at', 'updated_at', 'last_login')
+USER_GENERATION_TTL = 86400  # outlives any cache-fill race by far
+
+# Fill the cache only if no invalidation bumped the generation since the database read
+SET_IF_GENERATION_LUA = """
+local generation = redis.call('GET', KEYS[2]) or ''
+if generation == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[3], 'EX', ARGV[2])
+    return 1
+end
+return 0
+"""
+_set_if_generation = redis_client.register_script(SET_IF_GENERATION_LUA)
+
+
+def _user_key(user_id):
+    return f"user:{user_id}"
+
+
+def _user_generation_key(user_id):
+    return f"user:{user_id}:gen"
+
+
+def _subscription_key(user_id):
+    return f"sub:{user_id}"
+
+
+def _stripe_subscription_key(subscription_id):
+    return f"stripe:sub:{subscription_id}"
+
+
+def _pack_user(user):
+    data = {}
+    for column in USER_CACHE_COLUMNS:
+        value = getattr(user, column)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        data[column] = value
+    return msgpack.packb(data)
+
+
+def _unpack_user(packed):
+    data = msgpack.unpackb(packed)
+    for column in USER_DATETIME_COLUMNS:
+        if data.get(column):
+            data[column] = datetime.fromisoformat(data[column])
+    
+    # Rebuild a clean persistent instance without touching the database
+    user = User(**data)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def cached_user(user_id):
+    """Get a user by id, serving the hot columns from Redis when possible"""
+    key = _user_key(user_id)
+    generation_key = _user_generation_key(user_id)
+    generation = None
+    
+    try:
+        packed, seen = redis_client.mget(key, generation_key)
+        generation = seen or b''
+        if packed:
+            return _unpack_user(packed)
+    except Exception:
+        logger.exception("User cache read error", extra={'user_id': user_id})
+    
+    user = db.session.get(User, user_id)
+    
+    # Without a generation to check against, skip the fill rather than risk a stale one
+    if user and generation is not None:
+        try:
+            _set_if_generation(
+                keys=[key, generation_key],
+                args=[generation, Config.USER_CACHE_TTL, _pack_user(user)]
+            )
+        except Exception:
+            logger.exception("User cache write error", extra={'user_id': user_id})
+    
+    return user
+
+
+def _invalidate_keys(pipe, user_id):
+    pipe.incr(_user_generation_key(user_id))
+    pipe.expire(_user_generation_key(user_id), USER_GENERATION_TTL)
+    pipe.delete(_user_key(user_id), _subscription_key(user_id))
+
+
+def invalidate_user(user_id):
+    """Drop a cached user (and the subscription payload built from it) after its row changes"""
+    try:
+        with redis_client.pipeline(transaction=False) as pipe:
+            _invalidate_keys(pipe, user_id)
+            pipe.execute()
+    except Exception:
+        logger.exception("User cache invalidation error", extra={'user_id': user_id})
+
+
+def invalidate_users(user_ids, stripe_subscription_ids=()):
+    """Drop several cached users (and Stripe subscriptions) in one pipelined round trip"""
+    if not user_ids and not stripe_subscription_ids:
+        return
+    
+    try:
+        with redis_client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                _invalidate_keys(pipe, user_id)
+            if stripe_subscription_ids:
+                pipe.delete(*[_stripe_subscription_key(subscription_id) for subscription_id in stripe_subscription_ids])
+            pipe.execute()
+    except Exception:
+        logger.exception("User cache invalidation error")
+
+
+def get_cached_subscription(user_id):
+    """Return the cached subscription JSON body, or None"""
+    try:
+        return redis_client.get(_subscription_key(user_id))
+    except Exception:
+        logger.exception("Subscription cache read error", extra={'user_id': user_id})
+        return None
+
+
+def cache_subscription(user_id, body):
+    """Store a serialized subscription payload for a short TTL"""
+    try:
+        redis_client.setex(_subscription_key(user_id), Config.SUBSCRIPTION_CACHE_TTL, body)
+    except Exception:
+        logger.exception("Subscription cache write error", extra={'user_id': user_id})
+
+
+def invalidate_subscription(user_id):
+    """Drop a cached subscription payload after a Stripe-side change"""
+    try:
+        redis_client.delete(_subscription_key(user_id))
+    except Exception:
+        logger.exception("Subscription cache invalidation error", extra={'user_id': user_id})
+
+
+def get_cached_stripe_subscription(subscription_id):
+    """Return the cached Stripe subscription fields, or None"""
+    try:
+        packed = redis_client.get(_stripe_subscription_key(subscription_id))
+        return msgpack.unpackb(packed) if packed else None
+    except Exception:
+        logger.exception("Stripe subscription cache read error", extra={'subscription_id': subscription_id})
+        return None
+
+
+def cache_stripe_subscription(subscription_id, data):
+    """Store Stripe subscription fields, never past the current period end"""
+    ttl = min(Config.STRIPE_SUBSCRIPTION_CACHE_TTL, int(data['current_period_end'] - time.time()))
+    if ttl <= 0:
+        return
+    
+    try:
+        redis_client.setex(_stripe_subscription_key(subscription_id), ttl, msgpack.packb(data))
+    except Exception:
+        logger.exception("Stripe subscription cache write error", extra={'subscription_id': subscription_id})
\ No newline at end of file
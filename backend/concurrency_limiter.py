@@ -0,0 +1,56 @@
+import time
+import uuid
+from cache import redis_client
+
+# Expire stale slots, then claim one only if the key is under its limit, atomically
+ACQUIRE_LUA = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local request_id = ARGV[4]
+
+redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+if redis.call('ZCARD', key) >= limit then
+    return 0
+end
+
+redis.call('ZADD', key, now, request_id)
+redis.call('EXPIRE', key, math.ceil(window))
+return 1
+"""
+
+
+class ConcurrencyLimiter:
+    """Cap in-flight requests per key with a Redis sorted set"""
+    
+    def __init__(self, name, limit, window):
+        self.name = name
+        self.limit = limit
+        self.window = window  # seconds before a slot leaked by a crashed request is reclaimed
+        self._acquire = redis_client.register_script(ACQUIRE_LUA)
+    
+    def _key(self, key):
+        return f"user:{key}:{self.name}"
+    
+    def acquire(self, key):
+        """Claim a slot; returns a request id to release, or None when the limit is reached"""
+        request_id = uuid.uuid4().hex
+        try:
+            acquired = self._acquire(
+                keys=[self._key(key)],
+                args=[time.time(), self.window, self.limit, request_id]
+            )
+        except Exception as e:
+            # Degrade open: a Redis outage must not block checkout
+            print(f"Concurrency limiter error: {e}")
+            return request_id
+        
+        return request_id if acquired else None
+    
+    def release(self, key, request_id):
+        """Free a slot claimed by acquire"""
+        try:
+            redis_client.zrem(self._key(key), request_id)
+        except Exception as e:
+            print(f"Concurrency limiter release error: {e}")
\ No newline at end of file
@@ -12,6 +12,19 @@ class Config:
     # Database
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'sqlite:///bob_email_ai.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'insertmanyvalues_page_size': int(os.getenv('DB_INSERT_PAGE_SIZE', 1000))
+    }
+    
+    # Server databases get a larger, recycled pool; SQLite keeps its own pooling
+    if not SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+        SQLALCHEMY_ENGINE_OPTIONS.update({
+            'pool_size': int(os.getenv('DB_POOL_SIZE', 20)),
+            'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+            'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+            'pool_pre_ping': True,
+            'pool_use_lifo': True
+        })
     
     # JWT
     JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY', 'jwt-secret-key-change-in-production')
@@ -20,6 +33,8 @@ class Config:
     
     # OpenAI
     OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+    OPENAI_RPM_LIMIT = int(os.getenv('OPENAI_RPM_LIMIT', 500))  # calls per minute across all workers
+    OPENAI_BURST_LIMIT = int(os.getenv('OPENAI_BURST_LIMIT', 100))
     
     # Stripe
     STRIPE_PUBLIC_KEY = os.getenv('STRIPE_PUBLIC_KEY')
@@ -28,8 +43,24 @@ class Config:
     
     # Redis
     REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+    USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 90))  # seconds
+    SUBSCRIPTION_CACHE_TTL = int(os.getenv('SUBSCRIPTION_CACHE_TTL', 60))  # seconds
+    STRIPE_SUBSCRIPTION_CACHE_TTL = int(os.getenv('STRIPE_SUBSCRIPTION_CACHE_TTL', 3600))  # seconds, capped at the period end
+    
+    # Celery (Stripe webhooks get their own queue so slow payment work can't starve other tasks)
+    WEBHOOK_CELERY_QUEUE_NAME = os.getenv('WEBHOOK_CELERY_QUEUE_NAME', 'stripe-webhooks')
+    CELERY = {
+        'broker_url': os.getenv('CELERY_BROKER_URL', REDIS_URL),
+        'task_ignore_result': True,
+        'task_acks_late': True,
+        'task_routes': {
+            'tasks.process_stripe_events': {'queue': WEBHOOK_CELERY_QUEUE_NAME},
+            'tasks.log_payments': {'queue': WEBHOOK_CELERY_QUEUE_NAME}
+        }
+    }
     
     # Rate Limits
+    CHECKOUT_CONCURRENCY_LIMIT = int(os.getenv('CHECKOUT_CONCURRENCY_LIMIT', 2))  # in-flight checkouts per user
     FREE_TIER_LIMIT = int(os.getenv('FREE_TIER_LIMIT', 10))
     PRO_TIER_LIMIT = int(os.getenv('PRO_TIER_LIMIT', 500))
     ENTERPRISE_TIER_LIMIT = int(os.getenv('ENTERPRISE_TIER_LIMIT', 10000))
@@ -4,49 +4,206 @@ from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
 from flask import current_app
 from models import User, db
+from cache import redis_client
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+import calendar
+import google_auth_httplib2
+import httplib2
+import msgpack
+import threading
 import json
+import re
 
 SCOPES = [
     'https://www.googleapis.com/auth/gmail.readonly',
     'https://www.googleapis.com/auth/gmail.modify'
 ]
 
+GMAIL_HTTP_TIMEOUT = 30  # seconds
+SERVICE_CACHE_SIZE = 1024
+CREDS_CACHE_SIZE = 1024
+
+# Built services keyed by (user_id, token hash), least recently used first
+_service_cache = OrderedDict()
+_service_cache_lock = threading.Lock()
+
+# httplib2.Http is not thread-safe; concurrent fetches for one user run on separate threads
+_http_local = threading.local()
+
+# Parsed credentials by user id, least recently used first; they only change on refresh or reconnect
+_creds_cache = OrderedDict()
+_creds_cache_lock = threading.Lock()
+
+
+def _thread_http():
+    """This thread's keep-alive httplib2 connection"""
+    http = getattr(_http_local, 'http', None)
+    if http is None:
+        http = _http_local.http = httplib2.Http(timeout=GMAIL_HTTP_TIMEOUT)
+    return http
+
+
+def build_gmail_service(user_id, creds):
+    """Reuse a per-user Gmail service; requests go out on the calling thread's connection"""
+    key = (user_id, hash(creds.token))
+    
+    with _service_cache_lock:
+        service = _service_cache.get(key)
+        if service is not None:
+            _service_cache.move_to_end(key)
+            return service
+    
+    def build_request(http, *args, **kwargs):
+        return HttpRequest(google_auth_httplib2.AuthorizedHttp(creds, http=_thread_http()), *args, **kwargs)
+    
+    # Bundled discovery doc, no per-build download or parse of a fetched copy
+    service = build(
+        'gmail', 'v1',
+        credentials=creds,
+        requestBuilder=build_request,
+        cache_discovery=False,
+        static_discovery=True
+    )
+    
+    with _service_cache_lock:
+        _service_cache[key] = service
+        while len(_service_cache) > SERVICE_CACHE_SIZE:
+            _service_cache.popitem(last=False)
+    
+    return service
+
+
+def invalidate_gmail_service(user_id):
+    """Drop cached services built from a user's old credentials"""
+    with _service_cache_lock:
+        for key in [k for k in _service_cache if k[0] == user_id]:
+            del _service_cache[key]
+
+
+def _cached_creds(user):
+    """Cached credentials, unless another worker stored a different refresh token since"""
+    with _creds_cache_lock:
+        creds = _creds_cache.get(user.id)
+        if creds is None:
+            return None
+        _creds_cache.move_to_end(user.id)
+    
+    if creds.refresh_token != user.gmail_refresh_token:
+        # Reconnected on another worker; refreshing these would write the old token back
+        evict_gmail_credentials(user.id)
+        return None
+    
+    return creds
+
+
+def _cache_creds(user_id, creds):
+    with _creds_cache_lock:
+        _creds_cache[user_id] = creds
+        _creds_cache.move_to_end(user_id)
+        while len(_creds_cache) > CREDS_CACHE_SIZE:
+            _creds_cache.popitem(last=False)
+
+
+def evict_gmail_credentials(user_id):
+    """Forget a user's parsed credentials and the services built from them"""
+    with _creds_cache_lock:
+        _creds_cache.pop(user_id, None)
+    invalidate_gmail_service(user_id)
+
+
+def _gmail_token_key(user_id):
+    return f"gmail:{user_id}"
+
+
+def share_gmail_token(user_id, creds):
+    """Publish a user's access token to other workers until it expires"""
+    if not creds.expiry:
+        return
+    
+    ttl = int((creds.expiry - datetime.utcnow()).total_seconds())
+    if ttl <= 0:
+        return
+    
+    try:
+        redis_client.setex(_gmail_token_key(user_id), ttl, msgpack.packb({
+            'token': creds.token,
+            'expiry': creds.expiry.isoformat()
+        }))
+    except Exception as e:
+        print(f"Gmail token cache write error: {e}")
+
+
+def adopt_shared_gmail_token(user_id, creds):
+    """Pick up an access token another worker already refreshed"""
+    try:
+        packed = redis_client.get(_gmail_token_key(user_id))
+        if packed:
+            shared = msgpack.unpackb(packed)
+            creds.token = shared['token']
+            creds.expiry = datetime.fromisoformat(shared['expiry'])
+    except Exception as e:
+        print(f"Gmail token cache read error: {e}")
+
+
+def load_gmail_credentials(user):
+    """Parse a user's stored Gmail credentials"""
+    if user.gmail_credentials_packed:
+        creds_data = msgpack.unpackb(user.gmail_credentials_packed, raw=False)
+    else:
+        creds_data = json.loads(user.gmail_credentials)
+    expiry = creds_data.get('expiry')
+    return Credentials(
+        token=creds_data['token'],
+        refresh_token=creds_data['refresh_token'],
+        token_uri=creds_data['token_uri'],
+        client_id=creds_data['client_id'],
+        client_secret=creds_data['client_secret'],
+        scopes=SCOPES,
+        expiry=datetime.fromisoformat(expiry) if expiry else None
+    )
+
 
 def get_gmail_service(user):
     """Get Gmail service for a specific user"""
-    creds = None
+    creds = _cached_creds(user)
     
     # Load credentials from database
-    if user.gmail_credentials:
+    if creds is None and user.has_gmail_credentials():
         try:
-            creds_data = json.loads(user.gmail_credentials)
-            creds = Credentials(
-                token=creds_data['token'],
-                refresh_token=creds_data['refresh_token'],
-                token_uri=creds_data['token_uri'],
-                client_id=creds_data['client_id'],
-                client_secret=creds_data['client_secret'],
-                scopes=SCOPES
-            )
+            creds = load_gmail_credentials(user)
         except Exception as e:
             print(f"Error loading credentials: {e}")
             return None
+        adopt_shared_gmail_token(user.id, creds)
+        _cache_creds(user.id, creds)
     
     # Check if credentials are valid
     if creds and creds.valid:
-        return build('gmail', 'v1', credentials=creds)
+        return build_gmail_service(user.id, creds)
     
     # Refresh if expired
     if creds and creds.expired and creds.refresh_token:
         try:
+            adopt_shared_gmail_token(user.id, creds)
+            if creds.valid:
+                return build_gmail_service(user.id, creds)
+            
+            old_token = creds.token
             creds.refresh(Request())
-            # Save refreshed credentials
-            save_gmail_credentials(user, creds)
-            return build('gmail', 'v1', credentials=creds)
+            # Save refreshed credentials (only when the token actually changed)
+            if creds.token != old_token:
+                save_gmail_credentials(user, creds)
+            return build_gmail_service(user.id, creds)
         except Exception as e:
             print(f"Error refreshing token: {e}")
+            # Reload from the database next time rather than retrying these credentials
+            evict_gmail_credentials(user.id)
             return None
     
     return None
@@ -60,11 +217,16 @@ def save_gmail_credentials(user, creds):
             'refresh_token': creds.refresh_token,
             'token_uri': creds.token_uri,
             'client_id': creds.client_id,
-            'client_secret': creds.client_secret
+            'client_secret': creds.client_secret,
+            'expiry': creds.expiry.isoformat() if creds.expiry else None
         }
-        user.gmail_credentials = json.dumps(creds_data)
+        user.gmail_credentials_packed = msgpack.packb(creds_data)
+        user.gmail_credentials = None
         user.gmail_refresh_token = creds.refresh_token
         db.session.commit()
+        _cache_creds(user.id, creds)
+        share_gmail_token(user.id, creds)
+        invalidate_gmail_service(user.id)
     except Exception as e:
         print(f"Error saving credentials: {e}")
         db.session.rollback()
@@ -137,6 +299,37 @@ def complete_gmail_oauth(user, auth_code, flow_data):
         raise Exception(f"OAuth completion failed: {str(e)}")
 
 
+GMAIL_BATCH_SIZE = 100  # Gmail caps a batch request at 100 calls
+METADATA_HEADERS = ['From', 'Subject', 'Date']
+
+# Optional (quoted) display name followed by an optional <angle-bracketed> address
+_FROM_RE = re.compile(r'(?:"?([^"<]*?)"?\s*)?<?([^<>\s]+@[^<>\s]+)>?')
+
+
+def parse_message(msg_detail):
+    """Convert a metadata-format Gmail message into an email dict"""
+    headers = {h['name']: h['value'] 
+              for h in msg_detail['payload'].get('headers', [])}
+    
+    sender = headers.get('From', '')
+    match = _FROM_RE.search(sender)
+    if match:
+        email = match.group(2)
+        sender_name = match.group(1) or email
+    else:
+        email = sender.split()[0] if sender else 'unknown'
+        sender_name = sender
+    
+    return {
+        'id': msg_detail['id'],
+        'sender': email,
+        'sender_name': sender_name,
+        'subject': headers.get('Subject', '(No Subject)'),
+        'snippet': msg_detail.get('snippet', ''),
+        'date': headers.get('Date', '')
+    }
+
+
 def fetch_emails(service, max_results=50):
     """Fetch emails from Gmail"""
     try:
@@ -146,42 +339,32 @@ def fetch_emails(service, max_results=50):
         ).execute()
         
         messages = results.get('messages', [])
+        details = {}
+        
+        def collect(request_id, response, exception):
+            if exception is not None:
+                print(f"Error processing message: {exception}")
+                return
+            details[response['id']] = response
+        
+        # Pipeline the per-message GETs through batch requests
+        for i in range(0, len(messages), GMAIL_BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=collect)
+            for msg in messages[i:i + GMAIL_BATCH_SIZE]:
+                batch.add(service.users().messages().get(
+                    userId='me',
+                    id=msg['id'],
+                    format='metadata',
+                    metadataHeaders=METADATA_HEADERS
+                ))
+            batch.execute()
         
         email_list = []
         for msg in messages:
+            if msg['id'] not in details:
+                continue
             try:
-                msg_detail = service.users().messages().get(
-                    userId='me',
-                    id=msg['id'],
-                    format='full'
-                ).execute()
-                
-                headers = {h['name']: h['value'] 
-                          for h in msg_detail['payload'].get('headers', [])}
-                
-                sender = headers.get('From', '')
-                if '<' in sender:
-                    email = sender.split('<')[1].split('>')[0]
-                    sender_name = sender.split('<')[0].strip().strip('"')
-                else:
-                    email = sender.split()[0] if sender else 'unknown'
-                    sender_name = sender
-                
-                subject = headers.get('Subject', '(No Subject)')
-                snippet = msg_detail.get('snippet', '')
-                date_str = headers.get('Date', '')
-                
-                email_data = {
-                    'id': msg['id'],
-                    'sender': email,
-                    'sender_name': sender_name,
-                    'subject': subject,
-                    'snippet': snippet,
-                    'date': date_str
-                }
-                
-                email_list.append(email_data)
-                
+                email_list.append(parse_message(details[msg['id']]))
             except Exception as e:
                 print(f"Error processing message: {e}")
                 continue
@@ -192,11 +375,19 @@ def fetch_emails(service, max_results=50):
         raise Exception(f"Failed to fetch emails: {str(e)}")
 
 
+# Same parse cache as api_server.py: Date headers repeat across messages and runs, and datetimes are immutable
+DATE_CACHE_SIZE = 4096
+parse_date = lru_cache(maxsize=DATE_CACHE_SIZE)(parsedate_to_datetime)
+
+
+def parse_send_time(date_str):
+    """Split a Date header into (hour, day name, ISO timestamp)"""
+    msg_time = parse_date(date_str)
+    return msg_time.hour, calendar.day_name[msg_time.weekday()], msg_time.isoformat()
+
+
 def analyze_email_patterns(emails):
     """Analyze email patterns to build engagement profiles"""
-    from collections import defaultdict
-    from email.utils import parsedate_to_datetime
-    
     profiles = defaultdict(lambda: {
         'sent_times': [],
         'topics': []
@@ -209,11 +400,11 @@ def analyze_email_patterns(emails):
             date_str = email_data['date']
             
             if date_str:
-                msg_time = parsedate_to_datetime(date_str)
+                hour, day, timestamp = parse_send_time(date_str)
                 profiles[sender]['sent_times'].append({
-                    'hour': msg_time.hour,
-                    'day': msg_time.strftime('%A'),
-                    'timestamp': msg_time.isoformat()
+                    'hour': hour,
+                    'day': day,
+                    'timestamp': timestamp
                 })
             
             profiles[sender]['topics'].append(subject)
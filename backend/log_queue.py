@@ -0,0 +1,67 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# Attributes every LogRecord has; anything else came from extra={...}
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'context'}
+
+_queue = queue.SimpleQueue()
+_handler = None
+_listener = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+class ContextFormatter(logging.Formatter):
+    """Append the extra={...} fields (user_id, event_id, ...) to each line"""
+    
+    def format(self, record):
+        context = ' '.join(
+            f"{key}={value}" for key, value in vars(record).items()
+            if key not in _RECORD_ATTRS
+        )
+        record.context = f" [{context}]" if context else ''
+        return super().format(record)
+
+
+class LazyQueueHandler(QueueHandler):
+    """Queue records, starting this process's listener on first use"""
+    
+    def emit(self, record):
+        _ensure_listener()
+        super().emit(record)
+
+
+def init_logging(level=logging.INFO):
+    """Route the root logger through a queue so request threads never block on stderr"""
+    global _handler
+    if _handler is not None:
+        return
+    
+    root = logging.getLogger()
+    root.setLevel(level)
+    _handler = LazyQueueHandler(_queue)
+    root.addHandler(_handler)
+
+
+def _ensure_listener():
+    # Started lazily so each forked (--preload) worker drains its own queue
+    global _listener, _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        
+        stream = logging.StreamHandler()
+        stream.setFormatter(ContextFormatter('%(asctime)s %(levelname)s %(name)s%(context)s: %(message)s'))
+        
+        # The listener thread does the actual writes; stopping it flushes what is queued
+        _listener = QueueListener(_queue, stream, respect_handler_level=True)
+        _listener.start()
+        _listener_pid = os.getpid()
+        atexit.register(_listener.stop)
\ No newline at end of file
@@ -0,0 +1,104 @@
+"""One-off schema upgrade for databases created before the packed Gmail credentials and the lookup indexes
+
+Run once per deploy, before the new app code takes traffic:
+
+    python migrate.py
+
+Every step checks the live schema first, so re-running is safe. On PostgreSQL the indexes are built
+with CREATE INDEX CONCURRENTLY and don't block writes; if one of those builds fails it leaves an
+INVALID index behind, which has to be dropped before re-running.
+"""
+import sys
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.schema import CreateIndex
+from config import Config
+from models import User, EmailAnalysis, UsageLog
+
+NEW_COLUMNS = (
+    (User.__table__, 'gmail_credentials_packed'),
+)
+NEW_INDEXES = (
+    (User.__table__, 'ix_users_stripe_customer_id'),
+    (EmailAnalysis.__table__, 'ix_email_analyses_user_created'),
+    (UsageLog.__table__, 'ix_usage_logs_user_ts'),
+)
+
+
+def add_columns(engine):
+    """Add columns db.create_all() won't add to an existing table"""
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    
+    for table, name in NEW_COLUMNS:
+        if name in {column['name'] for column in inspector.get_columns(table.name)}:
+            print(f"✓ Column {table.name}.{name} already exists")
+            continue
+        
+        column_type = table.c[name].type.compile(dialect=engine.dialect)
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(name)} {column_type}"))
+        print(f"✅ Added column {table.name}.{name}")
+
+
+def check_unique_customers(engine):
+    """Refuse to build the unique customer index over duplicate stripe_customer_id values"""
+    with engine.connect() as conn:
+        duplicates = conn.execute(text(
+            "SELECT stripe_customer_id, COUNT(*) FROM users "
+            "WHERE stripe_customer_id IS NOT NULL "
+            "GROUP BY stripe_customer_id HAVING COUNT(*) > 1"
+        )).all()
+    
+    if duplicates:
+        # Which user really owns the customer can't be decided here; Stripe's dashboard can
+        for customer_id, count in duplicates:
+            print(f"❌ Stripe customer {customer_id} is shared by {count} users")
+        raise RuntimeError(
+            f"{len(duplicates)} duplicated stripe_customer_id value(s); "
+            "clear the wrong users' ids and re-run"
+        )
+
+
+def create_indexes(engine):
+    """Build the indexes an existing database is missing"""
+    inspector = inspect(engine)
+    concurrently = engine.dialect.name == 'postgresql'
+    
+    for table, name in NEW_INDEXES:
+        if name in {index['name'] for index in inspector.get_indexes(table.name)}:
+            print(f"✓ Index {name} already exists")
+            continue
+        
+        index = next(index for index in table.indexes if index.name == name)
+        ddl = CreateIndex(index)
+        if concurrently:
+            index.dialect_kwargs['postgresql_concurrently'] = True
+            # CONCURRENTLY can't run inside a transaction block
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(ddl)
+        else:
+            with engine.begin() as conn:
+                conn.execute(ddl)
+        print(f"✅ Created index {name}")
+
+
+def main():
+    engine = create_engine(Config.SQLALCHEMY_DATABASE_URI)
+    if not inspect(engine).has_table(User.__tablename__):
+        print("No existing schema; the app's db.create_all() builds everything current")
+        return 0
+    
+    try:
+        add_columns(engine)
+        check_unique_customers(engine)
+        create_indexes(engine)
+    except Exception as e:
+        print(f"❌ Migration failed: {e}")
+        return 1
+    
+    print("✅ Schema is up to date")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
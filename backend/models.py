@@ -1,13 +1,42 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import Config
 import secrets
+import sqlite3
 
 db = SQLAlchemy()
 bcrypt = Bcrypt()
 
+
+# pysqlite begins transactions lazily on its own, which breaks SAVEPOINT (begin_nested).
+# Let SQLAlchemy emit BEGIN itself, per the SQLAlchemy pysqlite recipe
+@event.listens_for(Engine, 'connect')
+def _sqlite_disable_implicit_begin(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.isolation_level = None
+
+
+@event.listens_for(Engine, 'begin')
+def _sqlite_explicit_begin(conn):
+    if conn.dialect.name == 'sqlite':
+        conn.exec_driver_sql('BEGIN')
+
+# Monthly email analysis allowance per subscription tier
+USAGE_LIMITS = {
+    'free': Config.FREE_TIER_LIMIT,
+    'pro': Config.PRO_TIER_LIMIT,
+    'enterprise': Config.ENTERPRISE_TIER_LIMIT
+}
+
 class User(db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        # Webhooks look users up by Stripe customer; NULLs (no customer yet) don't collide
+        db.Index('ix_users_stripe_customer_id', 'stripe_customer_id', unique=True),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(255), unique=True, nullable=False)
@@ -29,7 +58,8 @@ class User(db.Model):
     
     # Gmail OAuth
     gmail_refresh_token = db.Column(db.Text)
-    gmail_credentials = db.Column(db.Text)
+    gmail_credentials = db.Column(db.Text)  # legacy JSON, superseded by the packed column
+    gmail_credentials_packed = db.Column(db.LargeBinary)  # msgpack
     
     # Timestamps
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -40,8 +70,8 @@ class User(db.Model):
     email_verified = db.Column(db.Boolean, default=False)
     verification_token = db.Column(db.String(255))
     
-    # Relationships
-    analyses = db.relationship('EmailAnalysis', backref='user', lazy=True, cascade='all, delete-orphan')
+    # Relationships (an accidental lazy load raises in debug; eager-load with selectinload where needed)
+    analyses = db.relationship('EmailAnalysis', backref='user', lazy='raise' if Config.DEBUG else 'select', cascade='all, delete-orphan')
     
     def set_password(self, password):
         self.password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
@@ -54,12 +84,10 @@ class User(db.Model):
         return self.api_key
     
     def get_usage_limit(self):
-        limits = {
-            'free': 10,
-            'pro': 500,
-            'enterprise': 10000
-        }
-        return limits.get(self.subscription_tier, 10)
+        return USAGE_LIMITS.get(self.subscription_tier, USAGE_LIMITS['free'])
+    
+    def has_gmail_credentials(self):
+        return bool(self.gmail_credentials_packed or self.gmail_credentials)
     
     def can_analyze_email(self):
         return self.emails_analyzed_this_month < self.get_usage_limit()
@@ -75,12 +103,15 @@ class User(db.Model):
             'usage_limit': self.get_usage_limit(),
             'api_key': self.api_key,
             'email_verified': self.email_verified,
-            'created_at': self.created_at.isoformat()
+            'created_at': self.created_at
         }
 
 
 class EmailAnalysis(db.Model):
     __tablename__ = 'email_analyses'
+    __table_args__ = (
+        db.Index('ix_email_analyses_user_created', 'user_id', db.text('created_at DESC')),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -129,12 +160,15 @@ class EmailAnalysis(db.Model):
                 'cta': self.cta,
                 'notes': self.notes
             },
-            'created_at': self.created_at.isoformat()
+            'created_at': self.created_at
         }
 
 
 class UsageLog(db.Model):
     __tablename__ = 'usage_logs'
+    __table_args__ = (
+        db.Index('ix_usage_logs_user_ts', 'user_id', db.text('timestamp DESC')),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
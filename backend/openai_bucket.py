@@ -0,0 +1,63 @@
+import math
+import time
+from cache import redis_client
+from config import Config
+
+# Refill, check and spend in one atomic step so concurrent workers can't overdraw
+TOKEN_BUCKET_LUA = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local capacity = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+
+local state = redis.call('HMGET', key, 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+
+redis.call('HSET', key, 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+return {allowed, tostring(retry_after)}
+"""
+
+
+class TokenBucket:
+    """Token bucket in Redis shared by every worker"""
+    
+    def __init__(self, key, rate, capacity):
+        self.key = key
+        self.rate = rate  # tokens per second
+        self.capacity = capacity
+        self._take = redis_client.register_script(TOKEN_BUCKET_LUA)
+    
+    def take(self, cost=1):
+        """Spend tokens if available; returns (allowed, retry_after_seconds)"""
+        cost = min(cost, self.capacity)
+        try:
+            allowed, retry_after = self._take(
+                keys=[self.key],
+                args=[time.time(), self.rate, self.capacity, cost]
+            )
+        except Exception as e:
+            # Degrade open: a Redis outage must not block analysis
+            print(f"OpenAI bucket error: {e}")
+            return True, 0
+        
+        return bool(allowed), math.ceil(float(retry_after))
+
+
+openai_bucket = TokenBucket(
+    'openai:rpm',
+    rate=Config.OPENAI_RPM_LIMIT / 60,
+    capacity=Config.OPENAI_BURST_LIMIT
+)
\ No newline at end of file
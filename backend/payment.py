@@ -1,14 +1,108 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from models import db, User, Payment
+from models import db, User
+from responses import ojsonify
+from cache import (
+    redis_client, invalidate_user, invalidate_users,
+    get_cached_subscription, cache_subscription, invalidate_subscription,
+    get_cached_stripe_subscription, cache_stripe_subscription
+)
+from tasks import (
+    process_stripe_events, log_payments, stripe_event_key,
+    STRIPE_EVENT_QUEUE, STRIPE_EVENT_QUEUED, STRIPE_EVENT_DEDUP_TTL
+)
+from concurrency_limiter import ConcurrencyLimiter
+from sqlalchemy import update
+from sqlalchemy.orm import load_only
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import requests
 import stripe
 from config import Config
+import orjson
+import functools
+import logging
+import hashlib
+import hmac
+import time
 import os
 
+logger = logging.getLogger(__name__)
+
 stripe.api_key = Config.STRIPE_SECRET_KEY
 
+# One keep-alive pool shared by every Stripe call in this process
+_stripe_session = requests.Session()
+_stripe_session.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.2)
+))
+stripe.default_http_client = stripe.RequestsClient(session=_stripe_session)
+
 payment_bp = Blueprint('payment', __name__)
 
+# The only User columns billing code reads or writes
+_BILLING_COLUMNS = load_only(
+    User.email,
+    User.stripe_customer_id,
+    User.subscription_tier,
+    User.subscription_status,
+    User.emails_analyzed_this_month,
+    User.stripe_subscription_id
+)
+
+
+# Bounds the Stripe calls a single user can have in flight
+checkout_limiter = ConcurrencyLimiter('ckout', limit=Config.CHECKOUT_CONCURRENCY_LIMIT, window=60)
+
+
+def get_billing_user(user_id):
+    """Load a user with just the billing columns"""
+    return db.session.get(User, user_id, options=[_BILLING_COLUMNS])
+
+
+# FOR NO KEY UPDATE: serializes concurrent webhook writers on the row without blocking FK inserts
+_BILLING_ROW_LOCK = {'key_share': True}
+
+
+def lock_billing_user(user_id):
+    """Load and row-lock a user's billing columns until the transaction ends"""
+    return db.session.get(User, user_id, options=[_BILLING_COLUMNS], with_for_update=_BILLING_ROW_LOCK)
+
+
+def update_billing_by_customer(customer_id, **values):
+    """Update the users owning a Stripe customer in one statement; returns their ids"""
+    # The UPDATE itself row-locks what it changes
+    if db.engine.dialect.update_returning:
+        user_ids = db.session.execute(
+            update(User)
+            .where(User.stripe_customer_id == customer_id)
+            .values(**values)
+            .returning(User.id)
+        ).scalars().all()
+    else:
+        # No UPDATE..RETURNING on this backend (e.g. MySQL): select the rows locked, then update them
+        users = (
+            User.query.options(_BILLING_COLUMNS)
+            .filter_by(stripe_customer_id=customer_id)
+            .with_for_update(**_BILLING_ROW_LOCK)
+            .all()
+        )
+        for user in users:
+            for column, value in values.items():
+                setattr(user, column, value)
+        user_ids = [user.id for user in users]
+    
+    # ix_users_stripe_customer_id rules this out once migrated; until then apply Stripe's state to every
+    # sharer rather than fail (and eventually dead-letter) each event for the customer
+    if len(user_ids) > 1:
+        logger.error(
+            "Stripe customer is shared by %d users; run migrate.py after resolving the duplicates",
+            len(user_ids), extra={'customer_id': customer_id, 'user_ids': user_ids}
+        )
+    return user_ids
+
 # Pricing plans
 PLANS = {
     'pro_monthly': {
@@ -32,11 +126,113 @@ PLANS = {
     }
 }
 
+# PLANS never changes at runtime, so the response body is serialized once
+_PLANS_JSON = orjson.dumps({'plans': PLANS})
+_PLANS_CACHE_CONTROL = 'public, max-age=300'
+
+# Checkout parameters that never vary per request, built once per self-serve plan
+_PLAN_LINE_ITEMS = {
+    plan_id: [{
+        'price_data': {
+            'currency': plan['currency'],
+            'product_data': {
+                'name': plan['name'],
+                'description': f"BOB 2 Email AI - {plan['name']}"
+            },
+            'unit_amount': plan['price'],
+            'recurring': {
+                'interval': plan['interval']
+            }
+        },
+        'quantity': 1
+    }]
+    for plan_id, plan in PLANS.items()
+    if isinstance(plan['price'], int)
+}
+_SUCCESS_URL = f"{Config.FRONTEND_URL}/dashboard?session_id={{CHECKOUT_SESSION_ID}}"
+_CANCEL_URL = f"{Config.FRONTEND_URL}/pricing"
+
+# Session.create with the plan-invariant arguments already bound
+_SESSION_CREATE_BY_PLAN = {
+    plan_id: functools.partial(
+        stripe.checkout.Session.create,
+        payment_method_types=['card'],
+        line_items=line_items,
+        mode='subscription',
+        success_url=_SUCCESS_URL,
+        cancel_url=_CANCEL_URL
+    )
+    for plan_id, line_items in _PLAN_LINE_ITEMS.items()
+}
+
+# Webhook signing key, encoded once; verification follows stripe.Webhook's scheme
+_WEBHOOK_SECRET_BYTES = (Config.STRIPE_WEBHOOK_SECRET or '').encode()
+WEBHOOK_TOLERANCE = 300  # seconds, Stripe's default replay window
+
+
+def verify_stripe_signature(payload, sig_header):
+    """Check a Stripe-Signature header against the raw request body"""
+    if not sig_header or not _WEBHOOK_SECRET_BYTES:
+        return False
+    
+    timestamp = None
+    signatures = []
+    for item in sig_header.split(','):
+        key, _, value = item.strip().partition('=')
+        if key == 't':
+            timestamp = value
+        elif key == 'v1':
+            # Several v1 entries appear while a signing secret is being rolled
+            signatures.append(value)
+    
+    if not timestamp or not timestamp.isdigit() or not signatures:
+        return False
+    if int(timestamp) < time.time() - WEBHOOK_TOLERANCE:
+        return False
+    
+    expected = hmac.new(_WEBHOOK_SECRET_BYTES, timestamp.encode() + b'.' + payload, hashlib.sha256).hexdigest()
+    return any(hmac.compare_digest(expected, signature) for signature in signatures)
+
+
+# Claim the event id and queue it in one round trip; a duplicate delivery queues nothing
+CLAIM_AND_QUEUE_LUA = """
+if redis.call('SET', KEYS[1], ARGV[3], 'NX', 'EX', ARGV[2]) then
+    redis.call('RPUSH', KEYS[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+_claim_and_queue = redis_client.register_script(CLAIM_AND_QUEUE_LUA)
+
+
+def queue_stripe_event(event_id):
+    """Queue an event for the worker; False if an earlier delivery already claimed it"""
+    return bool(_claim_and_queue(
+        keys=[stripe_event_key(event_id), STRIPE_EVENT_QUEUE],
+        args=[event_id, STRIPE_EVENT_DEDUP_TTL, STRIPE_EVENT_QUEUED]
+    ))
+
+
+def release_stripe_event(event_id):
+    """Unqueue and forget a claimed event so Stripe's retry can be queued"""
+    try:
+        with redis_client.pipeline(transaction=False) as pipe:
+            pipe.lrem(STRIPE_EVENT_QUEUE, 0, event_id)
+            pipe.delete(stripe_event_key(event_id))
+            pipe.execute()
+    except Exception:
+        logger.exception("Webhook dedup release error", extra={'event_id': event_id})
+
 
 @payment_bp.route('/plans', methods=['GET'])
 def get_plans():
     """Get available pricing plans"""
-    return jsonify({'plans': PLANS}), 200
+    return Response(
+        _PLANS_JSON,
+        status=200,
+        mimetype='application/json',
+        headers={'Cache-Control': _PLANS_CACHE_CONTROL}
+    )
 
 
 @payment_bp.route('/create-checkout-session', methods=['POST'])
@@ -45,60 +241,65 @@ def create_checkout_session():
     """Create Stripe checkout session"""
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        user = get_billing_user(user_id)
         
         if not user:
-            return jsonify({'error': 'User not found'}), 404
+            return ojsonify({'error': 'User not found'}, 404)
         
         data = request.json
         plan_id = data.get('plan_id')
         
         if plan_id not in PLANS:
-            return jsonify({'error': 'Invalid plan'}), 400
+            return ojsonify({'error': 'Invalid plan'}, 400)
         
         plan = PLANS[plan_id]
         
-        # Create or get Stripe customer
-        if not user.stripe_customer_id:
-            customer = stripe.Customer.create(
-                email=user.email,
-                metadata={'user_id': user.id}
-            )
-            user.stripe_customer_id = customer.id
-            db.session.commit()
+        if plan_id not in _SESSION_CREATE_BY_PLAN:
+            return ojsonify({'error': 'This plan is not available for online checkout'}, 400)
         
-        # Create checkout session
-        session = stripe.checkout.Session.create(
+        slot = checkout_limiter.acquire(user.id)
+        if slot is None:
+            return ojsonify({'error': 'A checkout is already in progress'}, 429)
+        
+        try:
+            checkout_url = start_checkout(user, plan_id, plan)
+        finally:
+            checkout_limiter.release(user.id, slot)
+        
+        return ojsonify({'checkout_url': checkout_url})
+    
+    except Exception as e:
+        return ojsonify({'error': str(e)}, 500)
+
+
+def start_checkout(user, plan_id, plan):
+    """Create the Stripe customer if needed and open a checkout session"""
+    # Create or get Stripe customer; the new id stays pending in the session
+    new_customer = not user.stripe_customer_id
+    if new_customer:
+        customer = stripe.Customer.create(
+            email=user.email,
+            metadata={'user_id': user.id}
+        )
+        user.stripe_customer_id = customer.id
+    
+    # Create checkout session
+    try:
+        session = _SESSION_CREATE_BY_PLAN[plan_id](
             customer=user.stripe_customer_id,
-            payment_method_types=['card'],
-            line_items=[{
-                'price_data': {
-                    'currency': plan['currency'],
-                    'product_data': {
-                        'name': plan['name'],
-                        'description': f"BOB 2 Email AI - {plan['name']}"
-                    },
-                    'unit_amount': plan['price'],
-                    'recurring': {
-                        'interval': plan['interval']
-                    } if plan['interval'] != 'custom' else None
-                },
-                'quantity': 1
-            }],
-            mode='subscription' if plan['interval'] != 'custom' else 'payment',
-            success_url=f"{Config.FRONTEND_URL}/dashboard?session_id={{CHECKOUT_SESSION_ID}}",
-            cancel_url=f"{Config.FRONTEND_URL}/pricing",
             metadata={
                 'user_id': user.id,
                 'plan_id': plan_id,
                 'tier': plan['tier']
             }
         )
-        
-        return jsonify({'checkout_url': session.url}), 200
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    finally:
+        # One commit for the whole checkout, and still keep the customer if Stripe failed
+        if new_customer:
+            db.session.commit()
+            invalidate_user(user.id)
+    
+    return session.url
 
 
 @payment_bp.route('/webhook', methods=['POST'])
@@ -107,94 +308,136 @@ def stripe_webhook():
     payload = request.data
     sig_header = request.headers.get('Stripe-Signature')
     
+    if not verify_stripe_signature(payload, sig_header):
+        return ojsonify({'error': 'Invalid signature'}, 400)
+    
     try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, Config.STRIPE_WEBHOOK_SECRET
-        )
-    except ValueError:
-        return jsonify({'error': 'Invalid payload'}), 400
-    except stripe.error.SignatureVerificationError:
-        return jsonify({'error': 'Invalid signature'}), 400
+        event = orjson.loads(payload)
+    except orjson.JSONDecodeError:
+        return ojsonify({'error': 'Invalid payload'}, 400)
+    
+    # Stripe may deliver the same event more than once; queue only the first.
+    # Acknowledge right away; a worker drains the queue in batches
+    if not queue_stripe_event(event['id']):
+        return ojsonify({'status': 'duplicate'})
+    
+    try:
+        process_stripe_events.delay()
+    except Exception:
+        release_stripe_event(event['id'])
+        raise
     
-    # Handle different event types
+    return ojsonify({'status': 'queued'})
+
+
+STRIPE_SUBSCRIPTION_EVENTS = ('customer.subscription.updated', 'customer.subscription.deleted')
+
+
+def dispatch_stripe_event(event):
+    """Route a Stripe event to its handler; returns the affected user ids"""
     if event['type'] == 'checkout.session.completed':
         session = event['data']['object']
-        handle_successful_payment(session)
+        return handle_successful_payment(session)
     
     elif event['type'] == 'customer.subscription.updated':
         subscription = event['data']['object']
-        handle_subscription_update(subscription)
+        return handle_subscription_update(subscription)
     
     elif event['type'] == 'customer.subscription.deleted':
         subscription = event['data']['object']
-        handle_subscription_cancel(subscription)
+        return handle_subscription_cancel(subscription)
     
-    return jsonify({'status': 'success'}), 200
+    return []
 
 
-def handle_successful_payment(session):
-    """Handle successful payment"""
-    try:
-        user_id = int(session['metadata']['user_id'])
-        tier = session['metadata']['tier']
+def apply_stripe_events(events):
+    """Apply a batch of Stripe events in one transaction; returns the ids of events that failed"""
+    touched_users = set()
+    touched_subscriptions = set()
+    payment_rows = []
+    failed_ids = []
+    
+    for event in events:
+        # Stripe already holds the new state, so a cached copy is stale whatever happens here
+        if event['type'] in STRIPE_SUBSCRIPTION_EVENTS:
+            touched_subscriptions.add(event['data']['object']['id'])
         
-        user = User.query.get(user_id)
-        if user:
-            user.subscription_tier = tier
-            user.subscription_status = 'active'
-            user.stripe_subscription_id = session.get('subscription')
-            
-            # Reset monthly usage
-            user.emails_analyzed_this_month = 0
-            
-            # Log payment
-            payment = Payment(
-                user_id=user.id,
-                stripe_payment_id=session['payment_intent'],
-                amount=session['amount_total'],
-                currency=session['currency'],
-                status='succeeded',
-                description=f"Subscription: {tier}"
+        try:
+            # A failing event rolls back only its own savepoint
+            with db.session.begin_nested():
+                user_ids = dispatch_stripe_event(event)
+            touched_users.update(user_ids)
+            if user_ids and event['type'] == 'checkout.session.completed':
+                payment_rows.append(build_payment_row(event, user_ids[0]))
+        except Exception:
+            logger.exception(
+                "Error applying Stripe event %s (%s)", event['id'], event['type'],
+                extra={'event_id': event['id']}
             )
-            
-            db.session.add(payment)
-            db.session.commit()
-            
-    except Exception as e:
-        print(f"Error handling payment: {e}")
-        db.session.rollback()
+            failed_ids.append(event['id'])
+    
+    db.session.commit()
+    invalidate_users(touched_users, touched_subscriptions)
+    
+    # The payment log is bookkeeping only, so it is written off the webhook path
+    if payment_rows:
+        try:
+            log_payments.delay(payment_rows)
+        except Exception:
+            logger.exception("Error queueing payment log", extra={'payments': len(payment_rows)})
+    
+    logger.info("Stripe webhook batch applied: TotalEventsInBatch=%d", len(events))
+    return failed_ids
+
+
+def handle_successful_payment(session):
+    """Handle successful payment"""
+    user_id = int(session['metadata']['user_id'])
+    tier = session['metadata']['tier']
+    
+    user = lock_billing_user(user_id)
+    if not user:
+        return []
+    
+    user.subscription_tier = tier
+    user.subscription_status = 'active'
+    user.stripe_subscription_id = session.get('subscription')
+    
+    # Reset monthly usage
+    user.emails_analyzed_this_month = 0
+    return [user.id]
+
+
+def build_payment_row(event, user_id):
+    """Payment log row for a completed checkout, as plain task arguments"""
+    session = event['data']['object']
+    return {
+        'user_id': user_id,
+        'stripe_payment_id': session['payment_intent'],
+        'amount': session['amount_total'],
+        'currency': session['currency'],
+        'status': 'succeeded',
+        'description': f"Subscription: {session['metadata']['tier']}",
+        'created': event['created']
+    }
 
 
 def handle_subscription_update(subscription):
     """Handle subscription update"""
-    try:
-        customer_id = subscription['customer']
-        user = User.query.filter_by(stripe_customer_id=customer_id).first()
-        
-        if user:
-            user.subscription_status = subscription['status']
-            db.session.commit()
-            
-    except Exception as e:
-        print(f"Error updating subscription: {e}")
-        db.session.rollback()
+    return update_billing_by_customer(
+        subscription['customer'],
+        subscription_status=subscription['status']
+    )
 
 
 def handle_subscription_cancel(subscription):
     """Handle subscription cancellation"""
-    try:
-        customer_id = subscription['customer']
-        user = User.query.filter_by(stripe_customer_id=customer_id).first()
-        
-        if user:
-            user.subscription_tier = 'free'
-            user.subscription_status = 'canceled'
-            user.emails_analyzed_this_month = 0
-            db.session.commit()
-            
-    except Exception as e:
-        print(f"Error canceling subscription: {e}")
-        db.session.rollback()
+    return update_billing_by_customer(
+        subscription['customer'],
+        subscription_tier='free',
+        subscription_status='canceled',
+        emails_analyzed_this_month=0
+    )
 
 
 @payment_bp.route('/subscription', methods=['GET'])
@@ -203,36 +446,62 @@ def get_subscription():
     """Get user's subscription details"""
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        
+        cached = get_cached_subscription(user_id)
+        if cached:
+            return Response(cached, status=200, mimetype='application/json', headers={'X-Cache': 'HIT'})
+        
+        user = get_billing_user(user_id)
         
         if not user:
-            return jsonify({'error': 'User not found'}), 404
+            return ojsonify({'error': 'User not found'}, 404)
+        
+        # Plain dict lookup in the tier table; a zero limit must not raise
+        usage_limit = user.get_usage_limit()
+        used = user.emails_analyzed_this_month
         
         subscription_data = {
             'tier': user.subscription_tier,
             'status': user.subscription_status,
             'usage': {
-                'current': user.emails_analyzed_this_month,
-                'limit': user.get_usage_limit(),
-                'percentage': (user.emails_analyzed_this_month / user.get_usage_limit()) * 100
+                'current': used,
+                'limit': usage_limit,
+                'percentage': 100.0 * used / usage_limit if usage_limit > 0 else 0.0
             }
         }
         
         # Get Stripe subscription if exists
         if user.stripe_subscription_id:
             try:
-                subscription = stripe.Subscription.retrieve(user.stripe_subscription_id)
-                subscription_data['stripe'] = {
-                    'current_period_end': subscription['current_period_end'],
-                    'cancel_at_period_end': subscription['cancel_at_period_end']
-                }
-            except:
-                pass
+                subscription_data['stripe'] = get_stripe_subscription(user.stripe_subscription_id)
+            except Exception:
+                logger.exception(
+                    "Error retrieving Stripe subscription",
+                    extra={'user_id': user.id}
+                )
         
-        return jsonify(subscription_data), 200
+        body = orjson.dumps(subscription_data)
+        cache_subscription(user_id, body)
         
+        return Response(body, status=200, mimetype='application/json', headers={'X-Cache': 'MISS'})
+    
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
+
+
+def get_stripe_subscription(subscription_id):
+    """Period fields of a Stripe subscription, cached until they can next change"""
+    cached = get_cached_stripe_subscription(subscription_id)
+    if cached:
+        return cached
+    
+    subscription = stripe.Subscription.retrieve(subscription_id)
+    data = {
+        'current_period_end': subscription['current_period_end'],
+        'cancel_at_period_end': subscription['cancel_at_period_end']
+    }
+    cache_stripe_subscription(subscription_id, data)
+    return data
 
 
 @payment_bp.route('/cancel-subscription', methods=['POST'])
@@ -241,21 +510,26 @@ def cancel_subscription():
     """Cancel user's subscription"""
     try:
         user_id = get_jwt_identity()
-        user = User.query.get(user_id)
+        user = get_billing_user(user_id)
         
         if not user or not user.stripe_subscription_id:
-            return jsonify({'error': 'No active subscription'}), 404
+            return ojsonify({'error': 'No active subscription'}, 404)
         
         # Cancel at period end (don't cancel immediately)
         subscription = stripe.Subscription.modify(
             user.stripe_subscription_id,
             cancel_at_period_end=True
         )
+        invalidate_subscription(user.id)
+        cache_stripe_subscription(subscription['id'], {
+            'current_period_end': subscription['current_period_end'],
+            'cancel_at_period_end': subscription['cancel_at_period_end']
+        })
         
-        return jsonify({
+        return ojsonify({
             'message': 'Subscription will be canceled at period end',
             'cancel_at': subscription['current_period_end']
-        }), 200
-        
+        })
+    
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return ojsonify({'error': str(e)}, 500)
\ No newline at end of file
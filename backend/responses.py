@@ -0,0 +1,20 @@
+from flask import Response
+from flask.json.provider import JSONProvider
+import orjson
+
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY
+
+
+class OrjsonProvider(JSONProvider):
+    """Serve every jsonify call through orjson instead of the stdlib encoder"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=ORJSON_OPTIONS).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+def ojsonify(data, status=200):
+    """Build a JSON response straight from orjson bytes"""
+    return Response(orjson.dumps(data, option=ORJSON_OPTIONS), status=status, mimetype='application/json')
\ No newline at end of file
@@ -0,0 +1,206 @@
+from celery import Celery, Task, shared_task
+from datetime import datetime
+from sqlalchemy import insert
+from models import db, Payment
+from cache import redis_client
+import logging
+import stripe
+import time
+
+STRIPE_EVENT_QUEUE = 'stripe:events'
+STRIPE_EVENT_DEAD_LETTER = 'stripe:events:dead'
+STRIPE_EVENT_ATTEMPTS = 'stripe:events:attempts'
+STRIPE_EVENT_BATCH_SIZE = 50
+STRIPE_EVENT_MAX_ATTEMPTS = 5  # per event, before it is parked on the dead-letter list
+STRIPE_EVENT_RETRY_DELAY = 30  # seconds
+STRIPE_EVENT_INFLIGHT = 'stripe:events:inflight'  # task id -> time it claimed its batch
+STRIPE_EVENT_STALE_AFTER = 900  # seconds; well past a batch's run time including task retries
+STRIPE_EVENT_SWEEP_LOCK = 'stripe:events:sweep'
+STRIPE_EVENT_SWEEP_INTERVAL = 60  # seconds
+STRIPE_EVENT_DONE = b'done'
+STRIPE_EVENT_QUEUED = 'queued'
+STRIPE_EVENT_DEDUP_TTL = 86400  # Stripe retries deliveries for up to three days, most within hours
+
+logger = logging.getLogger(__name__)
+
+
+def celery_init_app(app):
+    """Create the Celery app with tasks running inside a Flask app context"""
+    class FlaskTask(Task):
+        def __call__(self, *args, **kwargs):
+            with app.app_context():
+                return self.run(*args, **kwargs)
+    
+    celery_app = Celery(app.name, task_cls=FlaskTask)
+    celery_app.config_from_object(app.config['CELERY'])
+    celery_app.set_default()
+    app.extensions['celery'] = celery_app
+    return celery_app
+
+
+def stripe_event_key(event_id):
+    """Redis key recording an event's state: queued, or done once its batch committed"""
+    return f"stripe:evt:{event_id}"
+
+
+def _processing_key(task_id):
+    return f"stripe:events:processing:{task_id}"
+
+
+def _claim_stripe_events(task_id):
+    """Move up to a batch of queued ids onto this task's processing list"""
+    processing_key = _processing_key(task_id)
+    
+    # A task redelivered after a worker crash (or retried) finishes the ids it had already claimed
+    claimed = redis_client.lrange(processing_key, 0, -1)
+    if claimed:
+        redis_client.zadd(STRIPE_EVENT_INFLIGHT, {task_id: time.time()})
+        event_ids = [event_id.decode() for event_id in claimed]
+    else:
+        with redis_client.pipeline() as pipe:
+            for _ in range(STRIPE_EVENT_BATCH_SIZE):
+                pipe.lmove(STRIPE_EVENT_QUEUE, processing_key, 'LEFT', 'RIGHT')
+            pipe.zadd(STRIPE_EVENT_INFLIGHT, {task_id: time.time()})
+            moved = pipe.execute()[:-1]
+        event_ids = [event_id.decode() for event_id in moved if event_id is not None]
+        if not event_ids:
+            redis_client.zrem(STRIPE_EVENT_INFLIGHT, task_id)
+            return []
+    
+    # Committed by an earlier run whose cleanup was lost; applying them again would double-apply
+    states = redis_client.mget([stripe_event_key(event_id) for event_id in event_ids])
+    done = [event_id for event_id, state in zip(event_ids, states) if state == STRIPE_EVENT_DONE]
+    if done:
+        with redis_client.pipeline() as pipe:
+            for event_id in done:
+                pipe.lrem(processing_key, 0, event_id)
+            pipe.hdel(STRIPE_EVENT_ATTEMPTS, *done)
+            pipe.execute()
+    return [event_id for event_id, state in zip(event_ids, states) if state != STRIPE_EVENT_DONE]
+
+
+def _finish_stripe_events(task_id, applied_ids, failed_ids):
+    """Settle a claimed batch after its commit; True if any ids were requeued for another try"""
+    requeue, dead = [], []
+    if failed_ids:
+        with redis_client.pipeline(transaction=False) as pipe:
+            for event_id in failed_ids:
+                pipe.hincrby(STRIPE_EVENT_ATTEMPTS, event_id, 1)
+            attempts = pipe.execute()
+        
+        for event_id, count in zip(failed_ids, attempts):
+            (dead if count >= STRIPE_EVENT_MAX_ATTEMPTS else requeue).append(event_id)
+    
+    # Marked done on its own first, so a batch whose cleanup below is lost isn't applied twice
+    if applied_ids:
+        with redis_client.pipeline(transaction=False) as pipe:
+            for event_id in applied_ids:
+                pipe.set(stripe_event_key(event_id), STRIPE_EVENT_DONE, ex=STRIPE_EVENT_DEDUP_TTL)
+            pipe.execute()
+    
+    with redis_client.pipeline() as pipe:
+        if requeue:
+            pipe.rpush(STRIPE_EVENT_QUEUE, *requeue)
+        if dead:
+            pipe.rpush(STRIPE_EVENT_DEAD_LETTER, *dead)
+            # Forget the claim so a redelivery from Stripe is queued again
+            pipe.delete(*[stripe_event_key(event_id) for event_id in dead])
+        settled = list(applied_ids) + dead
+        if settled:
+            pipe.hdel(STRIPE_EVENT_ATTEMPTS, *settled)
+        pipe.delete(_processing_key(task_id))
+        pipe.zrem(STRIPE_EVENT_INFLIGHT, task_id)
+        pipe.execute()
+    
+    for event_id in dead:
+        logger.error("Stripe event dead-lettered after %d attempts", STRIPE_EVENT_MAX_ATTEMPTS, extra={'event_id': event_id})
+    
+    return bool(requeue)
+
+
+def _requeue_processing(task_id):
+    """Hand a task's claimed ids back to the queue"""
+    processing_key = _processing_key(task_id)
+    event_ids = redis_client.lrange(processing_key, 0, -1)
+    with redis_client.pipeline() as pipe:
+        if event_ids:
+            pipe.rpush(STRIPE_EVENT_QUEUE, *event_ids)
+        pipe.delete(processing_key)
+        pipe.zrem(STRIPE_EVENT_INFLIGHT, task_id)
+        pipe.execute()
+    return len(event_ids)
+
+
+def _sweep_stale_claims():
+    """Requeue batches claimed by tasks that stopped without settling them"""
+    # At most one sweep per interval across all workers
+    if not redis_client.set(STRIPE_EVENT_SWEEP_LOCK, '1', nx=True, ex=STRIPE_EVENT_SWEEP_INTERVAL):
+        return
+    
+    cutoff = time.time() - STRIPE_EVENT_STALE_AFTER
+    for task_id in redis_client.zrangebyscore(STRIPE_EVENT_INFLIGHT, '-inf', cutoff):
+        task_id = task_id.decode()
+        count = _requeue_processing(task_id)
+        logger.warning("Requeued %d Stripe events from a stale claim", count, extra={'task_id': task_id})
+
+
+@shared_task(bind=True, max_retries=5, default_retry_delay=10)
+def process_stripe_events(self):
+    """Drain queued Stripe event ids and apply them with a single commit"""
+    from payment import apply_stripe_events
+    
+    try:
+        _sweep_stale_claims()
+    except Exception:
+        logger.exception("Stripe event sweep error")
+    
+    # Ids stay on a per-task list until the commit; the sweep recovers lists nobody settles
+    task_id = self.request.id
+    event_ids = _claim_stripe_events(task_id)
+    if not event_ids:
+        return
+    
+    # Only ids travel through the queue; Stripe is the source of truth.
+    # One unretrievable event fails alone instead of holding back the batch
+    events = []
+    failed_ids = []
+    for event_id in event_ids:
+        try:
+            events.append(stripe.Event.retrieve(event_id))
+        except Exception:
+            logger.exception("Error retrieving Stripe event", extra={'event_id': event_id})
+            failed_ids.append(event_id)
+    
+    try:
+        if events:
+            failed_ids += apply_stripe_events(events)
+    except Exception as e:
+        # Nothing was committed; the retry reprocesses the claimed ids
+        if self.request.retries >= self.max_retries:
+            _requeue_processing(task_id)
+            process_stripe_events.apply_async(countdown=STRIPE_EVENT_RETRY_DELAY)
+        raise self.retry(exc=e)
+    
+    # Only now, after the commit, are the applied events marked done
+    failed = set(failed_ids)
+    applied_ids = [event_id for event_id in event_ids if event_id not in failed]
+    if _finish_stripe_events(task_id, applied_ids, failed_ids):
+        process_stripe_events.apply_async(countdown=STRIPE_EVENT_RETRY_DELAY)
+
+
+@shared_task(bind=True, max_retries=5, default_retry_delay=10)
+def log_payments(self, rows):
+    """Write a webhook batch's payment log rows with one bulk INSERT"""
+    # New dicts: retries re-send these same arguments, so they must stay untouched.
+    # Stripe's event time is kept so a delayed write still records when the payment happened
+    values = [
+        {k: v for k, v in row.items() if k != 'created'} | {'created_at': datetime.utcfromtimestamp(row['created'])}
+        for row in rows
+    ]
+    
+    try:
+        db.session.execute(insert(Payment), values)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise self.retry(exc=e)
\ No newline at end of file
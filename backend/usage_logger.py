@@ -0,0 +1,85 @@
+"""Background, batched writes of usage log rows
+
+Rows wait in process memory for up to FLUSH_INTERVAL seconds before their INSERT. A clean shutdown
+drains them through atexit, but a worker that dies without running it (SIGKILL, the OOM killer,
+a timed-out gunicorn worker killed before its abort handler gets to run) loses whatever is queued.
+That is an accepted trade-off for an audit trail: quotas are counted on the user row, which is
+still written synchronously, so only log rows can be lost and never billing or limit state.
+"""
+import atexit
+import queue
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import insert
+from models import db, UsageLog
+
+FLUSH_INTERVAL = 2  # seconds
+MAX_BATCH = 500
+
+_queue = queue.Queue()
+_app = None
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def init_app(app):
+    """Bind the logger to the app whose database the flushes write to"""
+    global _app
+    _app = app
+    atexit.register(flush)
+
+
+def emit(user_id, action, details=None):
+    """Queue a usage log row; it is written in the background"""
+    _queue.put({
+        'user_id': user_id,
+        'action': action,
+        'details': details,
+        'timestamp': datetime.utcnow()
+    })
+    _ensure_worker()
+
+
+def _ensure_worker():
+    # Started lazily so each forked server worker gets its own flusher
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+    
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name='usage-logger', daemon=True)
+            _worker.start()
+
+
+def _drain():
+    rows = []
+    while len(rows) < MAX_BATCH:
+        try:
+            rows.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return rows
+
+
+def flush():
+    """Write all queued usage logs with bulk INSERTs"""
+    if _app is None:
+        return
+    
+    rows = _drain()
+    while rows:
+        try:
+            with _app.app_context():
+                db.session.execute(insert(UsageLog), rows)
+                db.session.commit()
+        except Exception as e:
+            print(f"Usage log flush error ({len(rows)} rows dropped): {e}")
+        rows = _drain()
+
+
+def _run():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush()
\ No newline at end of file
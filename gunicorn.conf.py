@@ -0,0 +1,10 @@
+import os
+
+# Run with: gunicorn -c gunicorn.conf.py api_server:app
+# Each gevent worker yields on Gmail/OpenAI network I/O, so a handful of
+# processes can keep many /api/analyze requests in flight at once.
+bind = f"0.0.0.0:{os.getenv('FLASK_PORT', 5000)}"
+worker_class = 'gevent'
+workers = int(os.getenv('GUNICORN_WORKERS', os.cpu_count() or 1))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))